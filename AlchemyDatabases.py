@@ -1,35 +1,26 @@
 from sqlalchemy import create_engine, MetaData, Table, Integer, String, \
-    Column, DateTime, ForeignKey, Numeric, BigInteger, Boolean
+    Column, DateTime, ForeignKey, Numeric, BigInteger, Boolean, Float
 
-import os
+import threading
 from datetime import datetime
-from sqlalchemy.orm import relationship, declarative_base, sessionmaker
+from sqlalchemy.orm import relationship, declarative_base
 import sqlalchemy.orm as sqla_orm
 import sqlalchemy as sqla
 
 
-CONFIG = {
-    "host": os.environ['TGBOT_DB_HOST'],
-    "user": os.environ['TGBOT_DB_USER'],
-    "password": os.environ['TGBOT_DB_PASS'],
-    "database": os.environ['TGBOT_DB_NAME'],
-}
-
-ENGINE = create_engine("mysql://%s:%s@%s:3306/%s" %
-                       (CONFIG["user"], CONFIG["password"], CONFIG["host"], CONFIG["database"]),
-                       echo=True)
-
 Base = declarative_base()
 
 class User(Base):
     __tablename__ = "users"
     user_id             = Column(Integer, primary_key=True)
-    tg_id               = Column(BigInteger, nullable=False)
+    tg_id               = Column(BigInteger, nullable=False, unique=True, index=True)
     username            = Column(String(32), nullable=True)
     first_name          = Column(String(64), nullable=True)
     last_name           = Column(String(64), nullable=True)
     registration_date   = Column(DateTime, nullable=True)
     last_seen_date      = Column(DateTime, nullable=True)
+    # Set by /leave, the account is being removed in the background
+    deleted_date        = Column(DateTime, nullable=True)
     photos              = relationship("Photo")
     storages            = relationship("Storage")
 
@@ -56,9 +47,12 @@ class Storage(Base):
     type                = Column(String(8), nullable=False)
     size                = Column(BigInteger, nullable=False)
     used_space          = Column(BigInteger, nullable=False)
+    photo_count         = Column(Integer, nullable=False, server_default="0")
     created_date        = Column(DateTime, nullable=True)
     modified_date       = Column(DateTime, nullable=True)
-    user_id             = Column(Integer, ForeignKey("users.user_id"))
+    # Change marker of the storage when the reconciler last went through it, see Reconciler.py
+    reconciled_mtime    = Column(Float(precision=53), nullable=True)
+    user_id             = Column(Integer, ForeignKey("users.user_id"), index=True)
     photos              = relationship("Photo")
 
     def __init__(self, path, user_id, type="local", size=256*1024*1024):
@@ -66,6 +60,7 @@ class Storage(Base):
         self.type = type
         self.size = size
         self.used_space = 0
+        self.photo_count = 0
         self.created_date = datetime.utcnow()
         self.modified_date = datetime.utcnow()
         self.user_id = user_id
@@ -81,17 +76,32 @@ class Photo(Base):
     photo_id            = Column(Integer, primary_key=True)
     filename            = Column(String(40), nullable=False)
     size                = Column(BigInteger, nullable=False)
-    hash                = Column(String(64), nullable=True)
+    hash                = Column(String(64), nullable=True, index=True)
+    # 64-bit difference hash of the image as a signed integer, see Perceptual.py
+    phash               = Column(BigInteger, nullable=True)
+    # Delivery variant and thumbnail generated after ingest, see Variants.py; their bytes count towards the quota
+    variant_count       = Column(Integer, nullable=False, server_default="0")
+    variants_size       = Column(BigInteger, nullable=False, server_default="0")
+    # Base weight for /random, raised by /fav; the age decay is applied on top when sampling, see PhotoIndex.py
+    weight              = Column(Float, nullable=False, server_default="1")
+    file_id             = Column(String(128), nullable=True)
+    file_unique_id      = Column(String(32), nullable=True, index=True)
     upload_date         = Column(DateTime, nullable=True)
-    storage_id          = Column(Integer, ForeignKey("storages.storage_id"))
-    user_id             = Column(Integer, ForeignKey("users.user_id"))
+    storage_id          = Column(Integer, ForeignKey("storages.storage_id"), index=True)
+    user_id             = Column(Integer, ForeignKey("users.user_id"), index=True)
 
-    def __init__(self, filename, size, hash, storage_id, user_id):
+    def __init__(self, filename, size, hash, storage_id, user_id, file_id=None, file_unique_id=None, phash=None):
         self.filename = filename
         self.size = size
         self.hash = hash
+        self.phash = phash
+        self.variant_count = 0
+        self.variants_size = 0
+        self.weight = 1.0
         self.storage_id = storage_id
         self.user_id = user_id
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
         self.upload_date = datetime.utcnow()
 
     def __repr__(self):
@@ -100,7 +110,65 @@ class Photo(Base):
         return res
 
 
-Base.metadata.create_all(bind=ENGINE)
+class UserSession(Base):
+    # Upload and deletion sessions shared by all bot processes, see Sessions.DatabaseSessionStore
+    __tablename__ = "user_sessions"
+    tg_id               = Column(BigInteger, primary_key=True, autoincrement=False)
+    kind                = Column(String(8), nullable=False)
+    chat_id             = Column(BigInteger, nullable=False)
+    started             = Column(Float(precision=53), nullable=False)
+    deadline            = Column(Float(precision=53), nullable=False)
+    photos              = Column(Integer, nullable=False, default=0)
+    duplicates          = Column(Integer, nullable=False, default=0)
+    out_of_space        = Column(Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        res = "<UserSession(tg_id=%s, kind=%s, photos=%s)>" % (
+            self.tg_id, self.kind, self.photos)
+        return res
+
 
-SESSION = sqla_orm.sessionmaker(bind=ENGINE, autoflush=True, autocommit=False, expire_on_commit=False)
+class Database:
+    # Engine and session factory are created on first use; importing the models never reads the
+    # environment or opens a connection, and the schema is only touched when asked to
+    def __init__(self, url: str, echo: bool = False):
+        self.url = url
+        self.echo = echo
+        self.lock = threading.Lock()
+        self._engine = None
+        self._sessionmaker = None
+
+    @property
+    def engine(self):
+        with self.lock:
+            if self._engine is None:
+                self._engine = create_engine(self.url, echo=self.echo)
+            return self._engine
+
+    @property
+    def sessionmaker(self):
+        engine = self.engine
+        with self.lock:
+            if self._sessionmaker is None:
+                self._sessionmaker = sqla_orm.sessionmaker(bind=engine, autoflush=True, autocommit=False,
+                                                           expire_on_commit=False)
+            return self._sessionmaker
+
+    def create_schema(self):
+        Base.metadata.create_all(bind=self.engine)
+
+    def check_schema(self) -> list[str]:
+        # Creates missing tables and returns the columns missing from existing ones, Migrations.py adds those.
+        # A handful of catalog queries instead of create_all's existence check per table.
+        inspector = sqla.inspect(self.engine)
+        existing = set(inspector.get_table_names())
+        if any(table.name not in existing for table in Base.metadata.sorted_tables):
+            self.create_schema()
+        missing = []
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            missing += [f"{table.name}.{column.name}" for column in table.columns if column.name not in columns]
+        return missing
 
@@ -0,0 +1,107 @@
+import time
+import logging
+import logging.handlers
+import threading
+from contextlib import contextmanager
+
+from telegram import Update
+from telegram.ext import CallbackContext, TypeHandler
+
+from AlchemyDatabases import Database
+from Config import Config
+from Photobot import Photobot
+import Metrics
+
+LOG_FORMAT = "%(asctime)s [%(levelname)-5.5s]  <%(name)s>  %(message)s"
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 10
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logging(config: Config):
+    # Console at the configured level, the log file from INFO up
+    formatter = logging.Formatter(LOG_FORMAT)
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    handlers = [console]
+    if config.log_file:
+        log_file = logging.handlers.RotatingFileHandler(config.log_file, mode='a', maxBytes=LOG_FILE_MAX_BYTES,
+                                                        backupCount=LOG_FILE_BACKUPS, encoding='UTF-8')
+        log_file.setFormatter(formatter)
+        log_file.setLevel(logging.INFO)
+        handlers.append(log_file)
+    logging.basicConfig(level=config.log_level, handlers=handlers, force=True)
+
+
+class StartupReport:
+    # Time spent in each startup phase, and from the start until the first update was handled
+    def __init__(self, started: float = None):
+        self.started = time.monotonic() if started is None else started
+        self.phases: dict[str, float] = {}
+        self.ready = None
+        self.first_update = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - started
+
+    def finish(self):
+        self.ready = time.monotonic() - self.started
+        Metrics.REGISTRY.gauge("photobot_startup_seconds", "Time from process start until the bot was built",
+                               lambda: self.ready)
+        Metrics.REGISTRY.gauge("photobot_first_update_seconds", "Time from process start until the first update",
+                               lambda: self.first_update or 0.0)
+        logger.info(self.summary())
+
+    def on_update(self, update: Update, context: CallbackContext):
+        # Runs before every other handler, only the first call records anything
+        if self.first_update is not None:
+            return
+        with self.lock:
+            if self.first_update is None:
+                self.first_update = time.monotonic() - self.started
+                logger.info(f"First update handled {self.first_update * 1000:.1f}ms after start")
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.phases.items())
+        return f"Startup took {self.ready * 1000:.1f}ms: {phases}"
+
+    def as_dict(self) -> dict:
+        result = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        result["total"] = round(self.ready * 1000, 3)
+        return result
+
+
+def prepare_schema(config: Config, database: Database):
+    if config.db_schema == "create":
+        database.create_schema()
+    elif config.db_schema == "check":
+        missing = database.check_schema()
+        if missing:
+            logger.error(f"Columns missing from the database, run Migrations.py: {', '.join(missing)}")
+
+
+def create_app(config: Config = None, database: Database = None, started: float = None) -> Photobot:
+    # Nothing is read, connected or created before this is called
+    report = StartupReport(started)
+    with report.phase("config"):
+        if config is None:
+            config = Config.from_env()
+    with report.phase("database"):
+        if database is None:
+            database = Database(config.database_url, echo=config.db_echo)
+        Metrics.instrument_engine(database.engine)
+    with report.phase("schema"):
+        prepare_schema(config, database)
+    with report.phase("bot"):
+        bot = Photobot(config, database)
+    bot.dispatcher.add_handler(TypeHandler(Update, report.on_update), group=-2)
+    bot.startup = report
+    report.finish()
+    return bot
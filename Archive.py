@@ -0,0 +1,203 @@
+import os
+import json
+import shutil
+import logging
+import zipfile
+import tempfile
+import contextlib
+from pathlib import Path
+from datetime import datetime
+from typing import Iterator, NamedTuple, Optional
+
+import telegram
+import sqlalchemy as sqla
+
+from AlchemyDatabases import Photo
+from StorageBackends import StorageBackend
+from Ingest import HashingWriter, IngestedFile, CHUNK_SIZE, copy_stream
+import Variants
+
+# Bots may send documents of up to 50MB, a part stays below that with room for the manifest and zip directory
+PART_SIZE = 48 * 1024 * 1024
+EXPORT_PAGE_SIZE = 500
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+# Larger zip entries are skipped on import, Telegram doesn't take photos that big either
+IMPORT_MAX_ENTRY_SIZE = 20 * 1024 * 1024
+# A small archive can unpack to far more than it weighs. Archives with more entries, or unpacking to more than
+# this multiple of the storage's free space (duplicates are unpacked before they are dropped), are refused.
+IMPORT_MAX_ENTRIES = 5000
+IMPORT_SPACE_FACTOR = 2
+IMPORT_MIN_BUDGET = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ExportJob(NamedTuple):
+    tg_id: int
+    chat_id: int
+    user_id: int
+    storage_path: str
+    storage_type: str
+
+
+class ImportJob(NamedTuple):
+    tg_id: int
+    chat_id: int
+    user_id: int
+    storage_id: int
+    storage_path: str
+    storage_type: str
+    document: telegram.Document
+
+
+class ExportEntry(NamedTuple):
+    photo_id: int
+    filename: str
+    size: int
+    hash: Optional[str]
+    file_unique_id: Optional[str]
+    upload_date: Optional[datetime]
+
+
+class ImportEntry(NamedTuple):
+    name: str
+    file: IngestedFile
+    extension: str
+
+
+def photo_pages(sessionmaker, user_id: int, page_size: int = EXPORT_PAGE_SIZE) -> Iterator[ExportEntry]:
+    # Keyset pages in short transactions, none is open while files are copied
+    after = 0
+    while True:
+        with sessionmaker.begin() as s:
+            rows = s.execute(
+                sqla.select(Photo.photo_id, Photo.filename, Photo.size, Photo.hash, Photo.file_unique_id,
+                            Photo.upload_date)
+                .where(Photo.user_id == user_id, Photo.photo_id > after)
+                .order_by(Photo.photo_id)
+                .limit(page_size)
+            ).all()
+        for row in rows:
+            yield ExportEntry(*row)
+        if len(rows) < page_size:
+            return
+        after = rows[-1].photo_id
+
+
+class ExportPart:
+    # One zip file being written; entries are stored uncompressed, photos don't get any smaller
+    def __init__(self, folder: Path):
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix=".zip")
+        self.path = Path(temp_path)
+        self.file = os.fdopen(fd, "w+b")
+        self.zip = zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED)
+        self.manifest = []
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @property
+    def size(self) -> int:
+        return self.file.tell()
+
+    def add(self, backend: StorageBackend, storage_path: str, entry: ExportEntry):
+        with contextlib.closing(backend.open(storage_path, entry.filename)) as source, \
+                self.zip.open(entry.filename, "w", force_zip64=True) as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        self.manifest.append({
+            "filename": entry.filename,
+            "size": entry.size,
+            "sha256": entry.hash,
+            "file_unique_id": entry.file_unique_id,
+            "upload_date": entry.upload_date.isoformat() if entry.upload_date else None,
+        })
+
+    def close(self) -> Path:
+        self.zip.writestr(MANIFEST_NAME, json.dumps({"version": MANIFEST_VERSION, "photos": self.manifest}, indent=1))
+        self.zip.close()
+        self.file.close()
+        return self.path
+
+    def discard(self):
+        with contextlib.suppress(Exception):
+            self.zip.close()
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def export_parts(entries: Iterator[ExportEntry], backend: StorageBackend, storage_path: str, folder: Path,
+                 part_size: int = PART_SIZE) -> Iterator[Path]:
+    # Yields finished zip parts, the caller sends and removes each one before the next is written.
+    # Files are copied in chunks, so memory use doesn't grow with the library. Every part has whole
+    # files and a manifest of its own, any of them can be imported alone.
+    folder.mkdir(parents=True, exist_ok=True)
+    part = None
+    try:
+        for entry in entries:
+            if part is not None and len(part) and part.size + entry.size > part_size:
+                path, part = part.close(), None
+                yield path
+            if part is None:
+                part = ExportPart(folder)
+            try:
+                part.add(backend, storage_path, entry)
+            except FileNotFoundError:
+                logger.warning(f"Photo {entry.photo_id} has no file {entry.filename}, not exported")
+        if part is not None:
+            path, part = part.close(), None
+            yield path
+    finally:
+        if part is not None:
+            part.discard()
+
+
+def read_manifest(archive: zipfile.ZipFile) -> dict[str, dict]:
+    # Entries of our own exports by filename; any zip of images is accepted without one
+    try:
+        with archive.open(MANIFEST_NAME) as f:
+            photos = json.load(f).get("photos", [])
+        return {photo["filename"]: photo for photo in photos if isinstance(photo, dict) and "filename" in photo}
+    except (KeyError, ValueError, AttributeError):
+        return {}
+
+
+def import_candidates(archive: zipfile.ZipFile,
+                      max_entry_size: int = IMPORT_MAX_ENTRY_SIZE) -> list[zipfile.ZipInfo]:
+    return [info for info in archive.infolist()
+            if not info.is_dir() and info.filename != MANIFEST_NAME and info.file_size <= max_entry_size]
+
+
+def import_budget(free_space: int) -> int:
+    return max(IMPORT_SPACE_FACTOR * free_space, IMPORT_MIN_BUDGET)
+
+
+def within_limits(archive: zipfile.ZipFile, free_space: int, max_entry_size: int = IMPORT_MAX_ENTRY_SIZE) -> bool:
+    # Checked on the declared sizes before anything is unpacked; zipfile never inflates an entry past its
+    # declared size, it fails the CRC check instead
+    candidates = import_candidates(archive, max_entry_size)
+    unpacked = sum(info.file_size for info in candidates)
+    return len(candidates) <= IMPORT_MAX_ENTRIES and unpacked <= import_budget(free_space)
+
+
+def import_entries(archive: zipfile.ZipFile, folder: Path,
+                   max_entry_size: int = IMPORT_MAX_ENTRY_SIZE) -> Iterator[ImportEntry]:
+    # Unpacks the images one at a time into hashed temp files, the caller takes ownership of each.
+    # Anything else in the zip (directories, the manifest, other files) is skipped.
+    folder.mkdir(parents=True, exist_ok=True)
+    for info in import_candidates(archive, max_entry_size):
+        with archive.open(info) as source:
+            head = source.read(12)
+            extension = Variants.image_extension(head)
+            if extension is None:
+                continue
+            fd, temp_path = tempfile.mkstemp(dir=folder, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    writer = HashingWriter(f)
+                    writer.write(head)
+                    copy_stream(source, writer)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        yield ImportEntry(info.filename, IngestedFile(Path(temp_path), writer.hexdigest(), writer.size), extension)
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import email.parser
+import email.policy
+from pathlib import Path
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench"
+
+
+class FakeBotApi:
+    # Minimal local stand-in for the Bot API: serves getFile and file downloads with generated bytes
+    # and accepts sendMessage/sendPhoto/sendMediaGroup, counting calls and bytes in both directions.
+    def __init__(self, photo_size: int = 200 * 1024, images: bool = False, listen: str = "127.0.0.1", port: int = 0):
+        self.photo_size = photo_size
+        self.images = images
+        self.lock = threading.Lock()
+        self.calls: dict[str, int] = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.message_id = 0
+        # Documents sent by the bot, by file_id, and the file_ids sent to every chat; they can be downloaded again
+        self.documents: dict[str, bytes] = {}
+        self.documents_by_chat: dict[int, list[str]] = {}
+        self.httpd = ThreadingHTTPServer((listen, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/file/bot"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, method: str, uploaded: int = 0, downloaded: int = 0):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.bytes_uploaded += uploaded
+            self.bytes_downloaded += downloaded
+
+    def file_bytes(self, file_id: str) -> bytes:
+        if file_id in self.documents:
+            return self.documents[file_id]
+        # Deterministic content per file_id, so resending a file_id resends the same photo
+        generator = random.Random(file_id)
+        if not self.images:
+            return generator.randbytes(self.photo_size)
+        # A decodable JPEG, so variants get rendered: a colour gradient with a little noise, 2048x1536
+        import io
+        from PIL import Image, ImageDraw
+        image = Image.new("RGB", (2048, 1536))
+        draw = ImageDraw.Draw(image)
+        base = [generator.randrange(256) for _ in range(3)]
+        for y in range(0, 1536, 8):
+            draw.rectangle((0, y, 2047, y + 7), fill=tuple((c + y // 8 + generator.randrange(16)) % 256 for c in base))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=95)
+        return buffer.getvalue()
+
+    def next_message(self, chat_id) -> dict:
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}}
+
+    def sent_photo(self, chat_id, media) -> dict:
+        message = self.next_message(chat_id)
+        uploaded = not isinstance(media, str) or not media or media.startswith("attach://")
+        file_id = f"sent-{message['message_id']}" if uploaded else media
+        message["photo"] = [{"file_id": file_id, "file_unique_id": f"u-{file_id}"[:32], "width": 800, "height": 600,
+                             "file_size": self.photo_size}]
+        return message
+
+    def call(self, method: str, data: dict, uploaded: int):
+        self.count(method, uploaded=uploaded)
+        chat_id = data.get("chat_id", 0)
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getFile":
+            file_id = data["file_id"]
+            size = len(self.documents[file_id]) if file_id in self.documents else self.photo_size
+            return {"file_id": file_id, "file_unique_id": f"u-{file_id}"[:32], "file_size": size,
+                    "file_path": f"photos/{file_id}.jpg"}
+        if method == "sendMessage":
+            message = self.next_message(chat_id)
+            message["text"] = data.get("text", "")
+            return message
+        if method == "sendPhoto":
+            return self.sent_photo(chat_id, data.get("photo"))
+        if method == "sendMediaGroup":
+            media = data.get("media")
+            media = json.loads(media) if isinstance(media, str) else media or []
+            return [self.sent_photo(chat_id, item.get("media", "")) for item in media]
+        if method == "sendDocument":
+            message = self.next_message(chat_id)
+            file_id = f"doc-{message['message_id']}"
+            content = data.get("document") or b""
+            with self.lock:
+                self.documents[file_id] = content
+                self.documents_by_chat.setdefault(int(chat_id), []).append(file_id)
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(content)}
+            return message
+        return True
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                # /file/bot<token>/photos/<file_id>.jpg
+                file_id = Path(self.path).stem
+                body = api.file_bytes(file_id)
+                api.count("download", downloaded=len(body))
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                data = self.decode(body)
+                method = self.path.rsplit("/", 1)[-1]
+                result = api.call(method, data, uploaded=length)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def decode(self, body: bytes) -> dict:
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+                    data = {}
+                    for part in message.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        # Uploaded files are kept as bytes, documents can be downloaded again
+                        data[name] = part.get_content() if part.get_filename() is None else part.get_payload(decode=True)
+                    return data
+                return json.loads(body) if body else {}
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {}
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self.lock:
+            self.update_id += 1
+            return self.update_id
+
+    def message(self, tg_id: int, **fields) -> dict:
+        update_id = self.next_id()
+        message = {"message_id": update_id, "date": int(time.time()),
+                   "chat": {"id": tg_id, "type": "private"},
+                   "from": {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}", "username": f"user{tg_id}"}}
+        message.update(fields)
+        return {"update_id": update_id, "message": message}
+
+    def command(self, tg_id: int, command: str, *args) -> dict:
+        text = " ".join((f"/{command}",) + args)
+        return self.message(tg_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command) + 1}])
+
+    def favorite(self, tg_id: int, n: int) -> dict:
+        # /fav as a reply to the n-th uploaded photo
+        update = self.command(tg_id, "fav")
+        update["message"]["reply_to_message"] = {
+            "message_id": 1, "date": int(time.time()), "chat": {"id": tg_id, "type": "private"},
+            "photo": [{"file_id": f"bench-{tg_id}-{n}", "file_unique_id": f"b{tg_id}-{n}", "width": 800, "height": 600}]}
+        return update
+
+    def document(self, tg_id: int, file_id: str, size: int) -> dict:
+        return self.message(tg_id, document={"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.zip",
+                                             "mime_type": "application/zip", "file_size": size})
+
+    def photo(self, tg_id: int, n: int, size: int) -> dict:
+        file_id = f"bench-{tg_id}-{n}"
+        return self.message(tg_id, photo=[{"file_id": file_id, "file_unique_id": f"b{tg_id}-{n}", "width": 800,
+                                           "height": 600, "file_size": size}])
+
+
+def disk_usage(folder: Path) -> int:
+    # Hardlinked files are counted once
+    seen, total = set(), 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the Photobot handlers")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--photos", type=int, default=10, help="photos uploaded per user")
+    parser.add_argument("--randoms", type=int, default=20, help="/random calls per user")
+    parser.add_argument("--album", type=int, default=1, help="photos asked for by each /random call")
+    parser.add_argument("--stats", type=int, default=5, help="/stats calls per user")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--photo-size", type=int, default=200 * 1024)
+    parser.add_argument("--images", action="store_true", help="serve real JPEGs instead of random bytes, needs Pillow")
+    parser.add_argument("--db", help="SQLAlchemy URL, a temporary sqlite database by default")
+    parser.add_argument("--json", help="write the results to this file as well")
+    args = parser.parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix="photobot-bench-"))
+    photos_folder = workdir / "photos"
+    photos_folder.mkdir()
+    api = FakeBotApi(photo_size=args.photo_size, images=args.images)
+    api.start()
+    started = time.monotonic()
+    import sqlalchemy as sqla
+    import App
+    import AlchemyDatabases
+    from AlchemyDatabases import Database
+    from Config import Config
+    from telegram import Update
+    imported = time.monotonic() - started
+
+    environ = dict(os.environ)
+    environ.update({
+        "TGBOT_API_KEY": BENCH_TOKEN,
+        "TGBOT_API_BASE_URL": api.base_url,
+        "TGBOT_API_BASE_FILE_URL": api.base_file_url,
+        "TGBOT_PHOTOS_FOLDER": str(photos_folder),
+        "TGBOT_DB_URL": args.db or f"sqlite:///{workdir / 'bench.db'}?timeout=30",
+        # Every user gets an importer account for the /import phase
+        "TGBOT_ACCOUNT_MAX_NUMBER": str(2 * args.users + 1),
+    })
+    config = Config.from_env(environ)._replace(webhook_url=None, db_echo=False, log_file=None)
+    logging.basicConfig(level=logging.WARNING)
+
+    queries = [0]
+    queries_lock = threading.Lock()
+    database = Database(config.database_url)
+
+    @sqla.event.listens_for(database.engine, "before_cursor_execute")
+    def count_query(*_):
+        with queries_lock:
+            queries[0] += 1
+
+    bot = App.create_app(config, database, started=started)
+    bot.jobs.start()
+    factory = UpdateFactory()
+    recorder = Recorder()
+    tg_ids = [100000 + n for n in range(args.users)]
+    importer_ids = [200000 + n for n in range(args.users)]
+    results = {"config": vars(args), "phases": {}}
+
+    def run_phase(name: str, updates: list[dict], drain=None):
+        decoded = [Update.de_json(update, bot.updater.bot) for update in updates]
+        queries_before, calls_before = queries[0], sum(api.calls.values())
+
+        def process(update):
+            started = time.perf_counter()
+            bot.dispatcher.process_update(update)
+            recorder.record(name, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(process, decoded))
+        if drain is not None:
+            drain()
+        bot.outbox.join()
+        elapsed = time.perf_counter() - started
+        latencies = recorder.latencies.get(name, [])
+        phase = {
+            "updates": len(decoded),
+            "seconds": round(elapsed, 4),
+            "updates_per_second": round(len(decoded) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "db_queries_per_update": round((queries[0] - queries_before) / max(len(decoded), 1), 2),
+            "api_calls_per_update": round((sum(api.calls.values()) - calls_before) / max(len(decoded), 1), 2),
+        }
+        results["phases"][name] = phase
+        return phase
+
+    def drain_ingest():
+        bot.ingest_pool.join()
+        if bot.variant_pool is not None:
+            bot.variant_pool.join()
+
+    try:
+        run_phase("register", [factory.command(tg_id, "register") for tg_id in tg_ids])
+        photo_updates = [factory.photo(tg_id, n, args.photo_size) for n in range(args.photos) for tg_id in tg_ids]
+        downloaded_before = api.bytes_downloaded
+        run_phase("photo_saver", photo_updates, drain=drain_ingest)
+        stored = max(len(photo_updates), 1)
+        results["phases"]["photo_saver"]["bytes_written_per_photo"] = round(disk_usage(photos_folder) / stored, 1)
+        results["phases"]["photo_saver"]["bytes_downloaded_per_photo"] = round((api.bytes_downloaded - downloaded_before) / stored, 1)
+        run_phase("favorite", [factory.favorite(tg_id, 0) for tg_id in tg_ids])
+        uploaded_before = api.bytes_uploaded
+        run_phase("random_photo", [factory.command(tg_id, "random", *([str(args.album)] if args.album > 1 else [])) for _ in range(args.randoms) for tg_id in tg_ids])
+        results["phases"]["random_photo"]["bytes_uploaded_per_update"] = round(
+            (api.bytes_uploaded - uploaded_before) / max(args.randoms * len(tg_ids), 1), 1)
+        run_phase("statistics", [factory.command(tg_id, "stats") for _ in range(args.stats) for tg_id in tg_ids])
+        # A full reconciliation pass, then one where every storage is unchanged and skipped
+        bot.reconciler.storages_per_run = len(tg_ids) + 1
+        passes = []
+        for _ in range(2):
+            started = time.perf_counter()
+            bot.reconciler.run()
+            passes.append(round((time.perf_counter() - started) * 1000, 3))
+        results["reconcile_ms"] = passes
+        # Every user exports the library, a fresh account imports the parts again
+        run_phase("export", [factory.command(tg_id, "export") for tg_id in tg_ids], drain=bot.export_pool.join)
+        results["phases"]["export"]["parts"] = sum(len(api.documents_by_chat.get(tg_id, [])) for tg_id in tg_ids)
+        run_phase("register_importers", [factory.command(tg_id, "register") for tg_id in importer_ids])
+        import_updates = [factory.document(importer_id, file_id, len(api.documents[file_id]))
+                          for tg_id, importer_id in zip(tg_ids, importer_ids) for file_id in api.documents_by_chat.get(tg_id, [])]
+
+        def drain_import():
+            bot.import_pool.join()
+            if bot.variant_pool is not None:
+                bot.variant_pool.join()
+
+        run_phase("import", import_updates, drain=drain_import)
+        with bot.sql.begin() as s:
+            results["phases"]["import"]["photos"] = s.execute(
+                sqla.select(sqla.func.count(AlchemyDatabases.Photo.photo_id))
+                .join(AlchemyDatabases.User, AlchemyDatabases.User.user_id == AlchemyDatabases.Photo.user_id)
+                .where(AlchemyDatabases.User.tg_id.in_(importer_ids))
+            ).scalar()
+        # Upload sessions would only time out after a while and /leave waits for them
+        everyone = tg_ids + importer_ids
+        for tg_id in everyone:
+            bot.sessions.pop(tg_id)
+        # /leave asks for a confirmation, the second call tombstones the account and the deleter does the rest
+        run_phase("leave_request", [factory.command(tg_id, "leave") for tg_id in everyone])
+        run_phase("leave", [factory.command(tg_id, "leave") for tg_id in everyone], drain=bot.deletion_pool.join)
+        results["phases"]["leave"]["bytes_left_on_disk"] = disk_usage(photos_folder)
+        results["startup_ms"] = dict(bot.startup.as_dict(), imports=round(imported * 1000, 3),
+                                     first_update=round(bot.startup.first_update * 1000, 3))
+        results["api_calls"] = dict(api.calls)
+        results["identity_cache"] = bot.identities.stats()
+    finally:
+        bot.shutdown()
+        bot.jobs.stop()
+        api.stop()
+
+    print(f"{'phase':<19}{'updates':>9}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/upd':>8}{'api/upd':>9}")
+    for name, phase in results["phases"].items():
+        print(f"{name:<19}{phase['updates']:>9}{phase['updates_per_second']:>10}{phase['p50_ms']:>10}"
+              f"{phase['p95_ms']:>10}{phase['p99_ms']:>10}{phase['db_queries_per_update']:>8}{phase['api_calls_per_update']:>9}")
+    photo_phase = results["phases"]["photo_saver"]
+    print(f"bytes written per photo: {photo_phase['bytes_written_per_photo']}, "
+          f"downloaded per photo: {photo_phase['bytes_downloaded_per_photo']}, "
+          f"uploaded per /random: {results['phases']['random_photo']['bytes_uploaded_per_update']}, "
+          f"left on disk after /leave: {results['phases']['leave']['bytes_left_on_disk']}")
+    print(f"export: {results['phases']['export']['parts']} parts, "
+          f"import: {results['phases']['import']['photos']} photos restored")
+    startup = results["startup_ms"]
+    print(f"startup: imports {startup['imports']}ms, schema {startup['schema']}ms, bot {startup['bot']}ms, "
+          f"ready after {startup['total']}ms, first update handled after {startup['first_update']}ms")
+    print(f"reconciliation: full pass {results['reconcile_ms'][0]}ms, unchanged pass {results['reconcile_ms'][1]}ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
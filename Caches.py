@@ -0,0 +1,59 @@
+import logging
+import threading
+from typing import NamedTuple, Optional
+
+import cachetools
+import sqlalchemy as sqla
+
+from AlchemyDatabases import User, Storage
+
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300
+
+
+class Identity(NamedTuple):
+    user_id: int
+    storage_id: int
+    storage_path: str
+    storage_size: int
+    storage_type: str
+
+
+class IdentityCache:
+    # tg_id -> user/storage resolution shared by all handlers; only complete registrations are cached
+    def __init__(self, sessionmaker, maxsize: int = IDENTITY_CACHE_SIZE, ttl: float = IDENTITY_CACHE_TTL):
+        self.logger = logging.getLogger(__name__)
+        self.sql = sessionmaker
+        self.lock = threading.Lock()
+        self.cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id: int) -> Optional[Identity]:
+        with self.lock:
+            identity = self.cache.get(tg_id)
+            if identity is not None:
+                self.hits += 1
+                return identity
+            self.misses += 1
+        with self.sql.begin() as s:
+            row = s.execute(
+                sqla.select(User.user_id, Storage.storage_id, Storage.path, Storage.size, Storage.type)
+                .join(Storage, Storage.user_id == User.user_id)
+                .where(User.tg_id == tg_id, User.deleted_date.is_(None))
+                .limit(1)
+            ).first()
+        if row is None:
+            return None
+        identity = Identity(*row)
+        with self.lock:
+            self.cache[tg_id] = identity
+        return identity
+
+    def invalidate(self, tg_id: int):
+        with self.lock:
+            self.cache.pop(tg_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache), "maxsize": self.cache.maxsize}
@@ -0,0 +1,179 @@
+import os
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+
+import telegram.error
+from telegram import Update
+from telegram.ext import Updater, TypeHandler, DispatcherHandlerStop, CallbackContext
+
+from AlchemyDatabases import Database
+from Config import Config
+import App
+
+CLUSTER_QUEUE_SIZE = 256
+# Updates are only held back when a worker falls this far behind, then they are dropped
+FORWARD_TIMEOUT = 30
+# A blocked forward looks for a replaced queue this often
+FORWARD_POLL = 1
+# Dead workers are noticed and restarted within this many seconds, which also paces a crash loop
+SUPERVISE_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+# Multi-process mode: the parent receives updates (polling or webhook) and forwards them as dicts to one of
+# N bot processes, chosen by tg_id, so every user's updates are processed by one process in order.
+# Sessions live in the database there; identity cache, photo index and ingest pool stay per process,
+# which is enough because a user never moves between processes while the cluster size stays the same.
+
+def partition(update: Update, size: int) -> int:
+    key = update.effective_user.id if update.effective_user else update.update_id
+    return key % size
+
+
+def worker_main(config: Config, updates: multiprocessing.Queue):
+    # Runs in a fresh interpreter (spawn) with the configuration prepared by Cluster.worker_config
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    App.setup_logging(config)
+    bot = App.create_app(config)
+    bot.jobs.start()
+    index, size = config.cluster_index, config.cluster_size
+    bot.logger.info(f"Worker {index}/{size} started, pid {os.getpid()}")
+    try:
+        while (data := updates.get()) is not None:
+            try:
+                bot.dispatcher.process_update(Update.de_json(data, bot.updater.bot))
+            except Exception as e:
+                bot.logger.exception(f"Worker {index} failed on an update: {e}")
+    finally:
+        bot.shutdown()
+        bot.jobs.stop()
+
+
+class Cluster:
+    def __init__(self, config: Config, queue_size: int = CLUSTER_QUEUE_SIZE):
+        self.config = config
+        self.size = config.worker_processes
+        self.queue_size = queue_size
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(self.size)]
+        self.processes = [self.spawn(index) for index in range(self.size)]
+        self.stopping = threading.Event()
+        self.supervisor = threading.Thread(target=self.supervise, name="cluster-supervisor", daemon=True)
+        self.updater = Updater(token=config.api_key, use_context=True, base_url=config.api_base_url,
+                               base_file_url=config.api_base_file_url)
+        # Group -1 runs before anything else and stops the dispatch, the parent never handles updates itself
+        self.updater.dispatcher.add_handler(TypeHandler(Update, self.forward), group=-1)
+
+    def worker_config(self, index: int) -> Config:
+        # Flood limits are per bot, not per process; every worker gets a metrics port of its own
+        return self.config._replace(
+            cluster_index=index,
+            cluster_size=self.size,
+            worker_processes=1,
+            outbox_rate=self.config.outbox_rate / self.size,
+            metrics_port=self.config.metrics_port + 1 + index if self.config.metrics_port else 0,
+            # The parent has prepared the schema, workers racing on the same DDL would fail
+            db_schema="off",
+        )
+
+    def spawn(self, index: int) -> multiprocessing.Process:
+        return self.context.Process(target=worker_main, args=(self.worker_config(index), self.queues[index]),
+                                    name=f"photobot-{index}", daemon=True)
+
+    def forward(self, update: Update, context: CallbackContext):
+        index = partition(update, self.size)
+        data = update.to_dict()
+        # Blocks when the worker is behind; in webhook mode the parent's queue then fills up and sheds with 503.
+        # The queue is looked up again on every try, a restarted worker gets a new one.
+        deadline = time.monotonic() + FORWARD_TIMEOUT
+        while True:
+            try:
+                self.queues[index].put(data, timeout=FORWARD_POLL)
+                break
+            except queue.Full:
+                if time.monotonic() >= deadline:
+                    logger.error(f"Worker {index} is {FORWARD_TIMEOUT}s behind, update {update.update_id} dropped")
+                    break
+        raise DispatcherHandlerStop()
+
+    def supervise(self):
+        while not self.stopping.wait(SUPERVISE_INTERVAL):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stopping.is_set():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                    self.restart(index)
+
+    def restart(self, index: int):
+        # A new queue, the dead worker may have held the old one's lock. The updates still in the old one
+        # are moved over; ones forwarded in the meantime may go first.
+        old = self.queues[index]
+        self.queues[index] = self.context.Queue(maxsize=self.queue_size)
+        moved = 0
+        try:
+            while True:
+                self.queues[index].put_nowait(old.get_nowait())
+                moved += 1
+        except (queue.Empty, queue.Full):
+            pass
+        self.processes[index] = self.spawn(index)
+        self.processes[index].start()
+        logger.info(f"Worker {index} restarted, {moved} queued updates kept")
+
+    def start(self):
+        # Once here rather than in every worker, see worker_config
+        database = Database(self.config.database_url, echo=self.config.db_echo)
+        App.prepare_schema(self.config, database)
+        database.engine.dispose()
+        for process in self.processes:
+            process.start()
+        self.supervisor.start()
+        logger.info(f"Started {self.size} bot processes")
+
+    def stop(self):
+        self.stopping.set()
+        for q in self.queues:
+            # A full queue belongs to a stuck or dead worker, it is terminated below
+            try:
+                q.put(None, timeout=FORWARD_POLL)
+            except queue.Full:
+                pass
+        for process in self.processes:
+            process.join(FORWARD_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    def run(self):
+        self.start()
+        try:
+            if self.config.webhook_url:
+                try:
+                    self.run_webhook()
+                    return
+                except telegram.error.TelegramError as e:
+                    logger.error(f"Couldn't set up the webhook: {e}; falling back to polling")
+            self.updater.start_polling()
+            self.updater.idle()
+        finally:
+            self.updater.stop()
+            self.stop()
+
+    def run_webhook(self):
+        from Webhook import WebhookServer
+        config = self.config
+        server = WebhookServer(self.updater.bot, self.updater.dispatcher, config.webhook_listen, config.webhook_port,
+                               config.webhook_path, workers=config.webhook_workers, queue_size=config.webhook_queue_size)
+        server.start()
+        try:
+            self.updater.bot.set_webhook(url=f"{config.webhook_url.rstrip('/')}/{config.webhook_path}",
+                                         max_connections=config.webhook_workers)
+            stopped = threading.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: stopped.set())
+            stopped.wait()
+        finally:
+            server.stop()
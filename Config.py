@@ -0,0 +1,133 @@
+import os
+import hashlib
+from pathlib import Path
+from typing import Mapping, NamedTuple, Optional
+
+ROOT_FOLDER = Path(__file__).parent
+
+
+def database_url(environ: Mapping[str, str] = None) -> str:
+    # TGBOT_DB_URL takes any SQLAlchemy URL (e.g. sqlite for local runs), the MySQL settings are used otherwise
+    environ = os.environ if environ is None else environ
+    url = environ.get('TGBOT_DB_URL')
+    if url is not None:
+        return url
+    return "mysql://%s:%s@%s:3306/%s" % (environ['TGBOT_DB_USER'], environ['TGBOT_DB_PASS'], environ['TGBOT_DB_HOST'],
+                                         environ['TGBOT_DB_NAME'])
+
+
+class Config(NamedTuple):
+    # Everything the bot takes from the environment, read once by from_env. A plain value object, so tests and
+    # the benchmark can build one directly and cluster workers get theirs through pickling.
+    api_key: str
+    database_url: str
+    # Statement logging is opt-in, the Metrics module counts and times queries instead
+    db_echo: bool = False
+    # "check" creates missing tables and reports missing columns, "create" always runs create_all, "off" skips both
+    db_schema: str = "check"
+    # Alternative Bot API server, e.g. a local one or the benchmark's stand-in
+    api_base_url: Optional[str] = None
+    api_base_file_url: Optional[str] = None
+    photos_folder: Path = ROOT_FOLDER / "photos"
+    account_max_number: int = 40
+    # Backend for new storages; existing storages keep the type they were created with
+    storage_default_type: str = "local"
+    s3_bucket: Optional[str] = None
+    s3_endpoint: Optional[str] = None
+    # "uniform" shows every photo once per round; "weighted", opt-in, favours favourites and recent uploads
+    random_mode: str = "uniform"
+    favorite_weight: float = 5.0
+    # A photo's chance halves every this many days after the upload, down to recency_floor; 0 turns that off
+    recency_half_life_days: float = 30.0
+    recency_floor: float = 0.1
+    ingest_workers: int = 4
+    ingest_queue_size: int = 32
+    # Replies are sent by the outbox threads, within Telegram's flood limits
+    outbox_senders: int = 4
+    outbox_rate: float = 30.0
+    outbox_chat_rate: float = 1.0
+    # Upload and deletion sessions are kept in memory, or in the database when several processes share the work
+    session_store: str = "memory"
+    # Number of bot processes and the position of this one, updates are partitioned by tg_id % cluster_size
+    worker_processes: int = 1
+    cluster_size: int = 1
+    cluster_index: int = 0
+    # Uploads within this Hamming distance of a stored photo's perceptual hash are "flag"ged in the log, or
+    # "skip"ped as duplicates when opted in, bursts and crops can match too; "off" turns the check off.
+    # It needs Pillow and NumPy.
+    phash_mode: str = "flag"
+    phash_distance: int = 6
+    # Delivery variants and thumbnails are rendered after ingest by these workers, when Pillow is installed
+    variant_workers: int = 2
+    variant_queue_size: int = 256
+    # /export and /import run on their own workers; archives bigger than the Bot API download limit can't be imported
+    archive_workers: int = 1
+    import_max_size: int = 20 * 1024 * 1024
+    # Storages are compared with their photo rows in the background; 0 turns the job off
+    reconcile_interval: int = 600
+    reconcile_rate: float = 1000.0
+    # Webhook mode is used when webhook_url is set, polling stays the default and the fallback
+    webhook_url: Optional[str] = None
+    webhook_listen: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_path: str = ""
+    webhook_workers: int = 8
+    webhook_queue_size: int = 64
+    # Prometheus endpoint is started when a port is given; /metrics in the chat is limited to these tg ids
+    metrics_listen: str = "127.0.0.1"
+    metrics_port: int = 0
+    admin_ids: frozenset = frozenset()
+    log_file: Optional[str] = "telegram.log"
+    log_level: str = "DEBUG"
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = None) -> "Config":
+        environ = os.environ if environ is None else environ
+        api_key = environ['TGBOT_API_KEY']
+        worker_processes = int(environ.get('TGBOT_WORKER_PROCESSES', 1))
+        return cls(
+            api_key=api_key,
+            database_url=database_url(environ),
+            db_echo=environ.get('TGBOT_DB_ECHO') == "1",
+            db_schema=environ.get('TGBOT_DB_SCHEMA', "check"),
+            api_base_url=environ.get('TGBOT_API_BASE_URL'),
+            api_base_file_url=environ.get('TGBOT_API_BASE_FILE_URL'),
+            photos_folder=Path(environ.get('TGBOT_PHOTOS_FOLDER', ROOT_FOLDER / "photos")),
+            account_max_number=int(environ.get('TGBOT_ACCOUNT_MAX_NUMBER', 40)),
+            storage_default_type=environ.get('TGBOT_STORAGE_TYPE', "local"),
+            s3_bucket=environ.get('TGBOT_S3_BUCKET'),
+            s3_endpoint=environ.get('TGBOT_S3_ENDPOINT'),
+            random_mode=environ.get('TGBOT_RANDOM_MODE', "uniform"),
+            favorite_weight=float(environ.get('TGBOT_FAVORITE_WEIGHT', 5)),
+            recency_half_life_days=float(environ.get('TGBOT_RECENCY_HALF_LIFE_DAYS', 30)),
+            recency_floor=float(environ.get('TGBOT_RECENCY_FLOOR', 0.1)),
+            ingest_workers=int(environ.get('TGBOT_INGEST_WORKERS', 4)),
+            ingest_queue_size=int(environ.get('TGBOT_INGEST_QUEUE_SIZE', 32)),
+            outbox_senders=int(environ.get('TGBOT_OUTBOX_SENDERS', 4)),
+            outbox_rate=float(environ.get('TGBOT_OUTBOX_RATE', 30)),
+            outbox_chat_rate=float(environ.get('TGBOT_OUTBOX_CHAT_RATE', 1)),
+            # Processes of a cluster have to share their sessions
+            session_store=environ.get('TGBOT_SESSION_STORE', "database" if worker_processes > 1 else "memory"),
+            worker_processes=worker_processes,
+            cluster_size=int(environ.get('TGBOT_CLUSTER_SIZE', 1)),
+            cluster_index=int(environ.get('TGBOT_CLUSTER_INDEX', 0)),
+            phash_mode=environ.get('TGBOT_PHASH_MODE', "flag"),
+            phash_distance=int(environ.get('TGBOT_PHASH_DISTANCE', 6)),
+            variant_workers=int(environ.get('TGBOT_VARIANT_WORKERS', 2)),
+            variant_queue_size=int(environ.get('TGBOT_VARIANT_QUEUE_SIZE', 256)),
+            archive_workers=int(environ.get('TGBOT_ARCHIVE_WORKERS', 1)),
+            import_max_size=int(environ.get('TGBOT_IMPORT_MAX_SIZE', 20 * 1024 * 1024)),
+            reconcile_interval=int(environ.get('TGBOT_RECONCILE_INTERVAL', 600)),
+            reconcile_rate=float(environ.get('TGBOT_RECONCILE_RATE', 1000)),
+            webhook_url=environ.get('TGBOT_WEBHOOK_URL'),
+            webhook_listen=environ.get('TGBOT_WEBHOOK_LISTEN', "0.0.0.0"),
+            webhook_port=int(environ.get('TGBOT_WEBHOOK_PORT', 8443)),
+            webhook_path=environ.get('TGBOT_WEBHOOK_PATH') or hashlib.sha256(api_key.encode()).hexdigest()[:32],
+            webhook_workers=int(environ.get('TGBOT_WEBHOOK_WORKERS', 8)),
+            webhook_queue_size=int(environ.get('TGBOT_WEBHOOK_QUEUE_SIZE', 64)),
+            metrics_listen=environ.get('TGBOT_METRICS_LISTEN', "127.0.0.1"),
+            metrics_port=int(environ.get('TGBOT_METRICS_PORT', 0)),
+            admin_ids=frozenset(int(tg_id) for tg_id in environ.get('TGBOT_ADMIN_IDS', "").split(",") if tg_id.strip()),
+            log_file=environ.get('TGBOT_LOG_FILE', "telegram.log") or None,
+            log_level=environ.get('TGBOT_LOG_LEVEL', "DEBUG"),
+        )
@@ -1,11 +1,15 @@
 import os
+import time
+import queue
+import random
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
 
 import mysql.connector
 
 import logging
 
-from mysql.connector import MySQLConnection
-
 from telegram.user import User as TgUser
 
 import datetime
@@ -13,59 +17,301 @@ import datetime
 STORAGE_DEFAULT_SIZE = 256*1024*1024
 STORAGE_DEFAULT_TYPE = "local"
 
+POOL_SIZE = 5
+POOL_TIMEOUT = 10
+CONNECT_MAX_TRIES = 5
+CONNECT_BACKOFF = 0.25
+CONNECT_BACKOFF_MAX = 8
+STREAM_BATCH_SIZE = 500
+INSERT_BATCH_SIZE = 1000
+
+CURSOR_PREPARED = "prepared"
+CURSOR_BUFFERED = "buffered"
+CURSOR_STREAM = "stream"
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    # A raw DB-API connection plus the statements already prepared on it
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.statements = {}
+        self.created = time.monotonic()
+
+
+class ConnectionPool:
+    # Size-bounded pool shared by all models. Connections are health-checked on checkout and opened
+    # with capped exponential backoff. The driver specific parts are passed in, so the pool runs
+    # against MySQL as well as against an sqlite3 stand-in (see ConnectionPool.sqlite).
+    def __init__(self, connect: Callable, check: Callable = None, cursor: Callable = None, paramstyle: str = "format",
+                 size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 max_tries: int = CONNECT_MAX_TRIES, backoff: float = CONNECT_BACKOFF, backoff_max: float = CONNECT_BACKOFF_MAX):
+        self.logger = logging.getLogger(__name__)
+        self.connect = connect
+        self.check = check or (lambda cnx: True)
+        self.make_cursor = cursor or (lambda cnx, kind: cnx.cursor())
+        self.paramstyle = paramstyle
+        self.size = size
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.idle: queue.LifoQueue[PooledConnection] = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.counters = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "timeouts": 0, "connects": 0,
+                         "connect_errors": 0, "failed_checks": 0, "query_errors": 0, "prepares": 0}
+
+    @classmethod
+    def mysql(cls, config: dict, **kwargs) -> "ConnectionPool":
+        def connect():
+            cnx = mysql.connector.connect(**config)
+            cnx.autocommit = True
+            return cnx
+
+        def cursor(cnx, kind):
+            if kind == CURSOR_PREPARED:
+                return cnx.cursor(prepared=True)
+            # Unbuffered cursors leave the result set on the server and fetch rows as they are read
+            return cnx.cursor(buffered=kind == CURSOR_BUFFERED)
+        return cls(connect, check=lambda cnx: cnx.is_connected(), cursor=cursor, paramstyle="format", **kwargs)
+
+    @classmethod
+    def sqlite(cls, database: str, **kwargs) -> "ConnectionPool":
+        import sqlite3
+
+        def connect():
+            return sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+
+        def check(cnx):
+            cnx.execute("SELECT 1")
+            return True
+        return cls(connect, check=check, paramstyle="qmark", **kwargs)
+
+    def count(self, counter: str, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def query(self, query: str) -> str:
+        return query.replace("%s", "?") if self.paramstyle == "qmark" else query
+
+    def open_connection(self) -> PooledConnection:
+        for n_try in range(1, self.max_tries + 1):
+            try:
+                cnx = self.connect()
+                self.count("connects")
+                return PooledConnection(cnx)
+            except Exception as err:
+                self.count("connect_errors")
+                self.logger.error("Failed to connect to database. Try {} of {}".format(n_try, self.max_tries))
+                if n_try == self.max_tries:
+                    self.logger.error("Failed to connect after {} tries.".format(self.max_tries))
+                    raise err
+                delay = min(self.backoff * 2 ** (n_try - 1), self.backoff_max)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def healthy(self, connection: PooledConnection) -> bool:
+        try:
+            return bool(self.check(connection.cnx))
+        except Exception:
+            return False
+
+    def discard(self, connection: PooledConnection):
+        with self.lock:
+            self.open -= 1
+        try:
+            connection.cnx.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        self.count("checkouts")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_open = self.open < self.size
+                    if can_open:
+                        self.open += 1
+                if can_open:
+                    try:
+                        return self.open_connection()
+                    except Exception:
+                        with self.lock:
+                            self.open -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.count("timeouts")
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                self.count("waits")
+                started = time.monotonic()
+                try:
+                    connection = self.idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                finally:
+                    self.count("wait_time", time.monotonic() - started)
+            if self.healthy(connection):
+                return connection
+            self.count("failed_checks")
+            self.discard(connection)
+
+    def release(self, connection: PooledConnection, broken: bool = False):
+        if broken:
+            self.discard(connection)
+        else:
+            self.idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except Exception:
+            self.count("query_errors")
+            broken = not self.healthy(connection)
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def prepared(self, connection: PooledConnection, query: str):
+        # One cursor per statement and connection, a prepared cursor only re-prepares when its statement changes
+        cursor = connection.statements.get(query)
+        if cursor is None:
+            cursor = connection.statements[query] = self.make_cursor(connection.cnx, CURSOR_PREPARED)
+            self.count("prepares")
+        return cursor
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {"size": self.size, "open": self.open, "idle": self.idle.qsize()}
+            stats.update(self.counters)
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def mysql_config(environ=None) -> dict:
+    environ = os.environ if environ is None else environ
+    return {
+        "host":     environ['TGBOT_DB_HOST'],
+        "user":     environ['TGBOT_DB_USER'],
+        "password": environ['TGBOT_DB_PASS'],
+        "database": environ['TGBOT_DB_NAME'],
+    }
+
 
 class Model:
     data = None
     lastrowid = None
     rowcount = None
-    cnx: MySQLConnection = None
-    cursor = None
-    n_tries = 0
-    max_tries = 5
-    config = {
-        "host":     os.environ['TGBOT_DB_HOST'],
-        "user":     os.environ['TGBOT_DB_USER'],
-        "password": os.environ['TGBOT_DB_PASS'],
-        "database": os.environ['TGBOT_DB_NAME'],
-    }
+    pool: ConnectionPool = None
+    pool_lock = threading.Lock()
+    # Read from the environment when the pool is first needed, see mysql_config
+    config: dict = None
 
     def __init__(self, table=None):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
         self.table = table
 
+    @classmethod
+    def get_pool(cls) -> ConnectionPool:
+        with Model.pool_lock:
+            if Model.pool is None:
+                config = cls.config if cls.config is not None else mysql_config()
+                Model.pool = ConnectionPool.mysql(config, size=int(os.environ.get('TGBOT_DB_POOL_SIZE', POOL_SIZE)))
+            return Model.pool
+
+    @classmethod
+    def use_pool(cls, pool: ConnectionPool):
+        with Model.pool_lock:
+            Model.pool = pool
+
     @property
     def is_connected(self):
-        if self.cnx is None or self.cursor is None:
-            return False
-        return self.cnx.is_connected()
+        return Model.pool is not None and Model.pool.stats()["open"] > 0
 
     def reconnect(self):
-        if not self.is_connected:
-            self.connect()
+        self.get_pool()
 
     def connect(self):
-        try:
-            self.n_tries += 1
-            self.cnx = mysql.connector.connect(**self.config)
-            self.cnx.autocommit = True
-            self.cursor = self.cnx.cursor(buffered=True, dictionary=True)
-            self.n_tries = 0
-        except mysql.connector.Error as err:
-            self.cursor = None
-            self.logger.error(
-                "Failed to connect to database. Try {} of {}".format(self.n_tries, self.max_tries))
-            if self.n_tries < self.max_tries:
-                self.logger.error("Trying to connect once again.")
-                self.connect()
-            else:
-                self.logger.error(
-                    "Failed to connect after {} tries.".format(self.max_tries))
-                raise err
+        self.get_pool()
 
     def close(self):
-        self.cursor.close()
-        self.cnx.close()
+        # Connections belong to the shared pool, there is nothing to close per model
+        pass
+
+    def execute(self, query, arguments=()):
+        pool = self.get_pool()
+        query = pool.query(query)
+        with pool.connection() as connection:
+            cursor = pool.prepared(connection, query)
+            cursor.execute(query, arguments)
+            self.rowcount = cursor.rowcount
+            self.lastrowid = cursor.lastrowid
+            if cursor.description is None:
+                return []
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def fetchall(self, query, arguments=()) -> list[dict]:
+        self.data = self.execute(query, arguments)
+        return self.data
+
+    def scalar(self, query, arguments=()):
+        rows = self.execute(query, arguments)
+        return next(iter(rows[0].values())) if rows else None
+
+    def execute_many(self, query, rows, batch_size=INSERT_BATCH_SIZE) -> int:
+        # Plain cursor on purpose: mysql.connector rewrites executemany INSERTs into multi-row VALUES
+        pool = self.get_pool()
+        query = pool.query(query)
+        rows = list(rows)
+        self.rowcount = 0
+        with pool.connection() as connection:
+            cursor = pool.make_cursor(connection.cnx, CURSOR_BUFFERED)
+            try:
+                for start in range(0, len(rows), batch_size):
+                    cursor.executemany(query, rows[start:start + batch_size])
+                    self.rowcount += max(cursor.rowcount, 0)
+            finally:
+                cursor.close()
+        return self.rowcount
+
+    def iterate(self, query, arguments=(), batch_size=STREAM_BATCH_SIZE) -> Iterator[dict]:
+        # Rows are read from an unbuffered cursor in batches, memory doesn't grow with the result set.
+        # The connection stays checked out until the generator is exhausted or closed.
+        pool = self.get_pool()
+        query = pool.query(query)
+        connection = pool.acquire()
+        cursor = None
+        exhausted = False
+        try:
+            cursor = pool.make_cursor(connection.cnx, CURSOR_STREAM)
+            cursor.execute(query, arguments)
+            names = [column[0] for column in cursor.description]
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    yield dict(zip(names, row))
+            exhausted = True
+        finally:
+            if cursor is not None and exhausted:
+                cursor.close()
+            # An unread server-side result set would poison the connection, so it is dropped instead
+            pool.release(connection, broken=not exhausted)
 
 
 class User(Model):
@@ -75,38 +321,27 @@ class User(Model):
     def select_by_user_id(self, user_id) -> list[dict]:
         function_name = "User.select_by_user_id"
         self.logger.debug(f"{function_name} called for {user_id}")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `users` WHERE user_id = %s;", (user_id,))
-        self.data = self.cursor.fetchall()
-        return self.data
+        return self.fetchall("SELECT * FROM `users` WHERE user_id = %s;", (user_id,))
 
     def select_by_tg_id(self, tg_id) -> list[dict]:
         function_name = "User.select_by_tg_id"
         self.logger.debug(f"{function_name} for {tg_id}")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `users` WHERE tg_id = %s;", (tg_id,))
-        self.data = self.cursor.fetchall()
-        return self.data
+        return self.fetchall("SELECT * FROM `users` WHERE tg_id = %s;", (tg_id,))
 
     def count(self) -> int:
         function_name = "User.count"
         self.logger.debug(f"{function_name} called")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `users`;")
-        self.rowcount = self.cursor.rowcount
+        self.rowcount = self.scalar("SELECT COUNT(*) FROM `users`;")
         return self.rowcount
 
     def insert(self, tg_id) -> int:
         function_name = "User.insert"
         self.logger.debug(f"{function_name} called for {tg_id}")
-        self.reconnect()
-        self.cursor.execute("INSERT INTO `users` (tg_id) VALUES (%s)", (tg_id,))
-        self.lastrowid = self.cursor.lastrowid
+        self.execute("INSERT INTO `users` (tg_id) VALUES (%s)", (tg_id,))
         return self.lastrowid
 
     def insert_by_tg_user(self, tg_user: TgUser, registrate: bool = False) -> int:
         self.logger.debug("")
-        self.reconnect()
         tg_id = tg_user.id
         tg_username = tg_user.username
         tg_first_name = tg_user.first_name
@@ -130,8 +365,7 @@ class User(Model):
             else:
                 query = "INSERT INTO `users` (tg_id, username, first_name, first_seen_date, last_seen_date, is_registered) VALUES (%s, %s, %s, %s, %s, %s);"
                 arguments = (tg_id, tg_username, tg_first_name, first_seen_date, last_seen_date, registrate)
-        self.cursor.execute(query, arguments)
-        self.lastrowid = self.cursor.lastrowid
+        self.execute(query, arguments)
         return self.lastrowid
 
 
@@ -142,39 +376,29 @@ class Storage(Model):
     def select_by_storage_id(self, storage_id) -> list[dict]:
         function_name = "Storage.select_by_storage_id"
         self.logger.debug(f"{function_name} called for {storage_id}")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `storages` WHERE storage_id = %s;", (storage_id,))
-        self.data = self.cursor.fetchall()
-        return self.data
+        return self.fetchall("SELECT * FROM `storages` WHERE storage_id = %s;", (storage_id,))
 
     def select_by_user_id(self, user_id) -> list[dict]:
         function_name = "Storage.select_by_user_id"
         self.logger.debug(f"{function_name} called for {user_id}")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `storages` WHERE user_id = %s;", (user_id,))
-        self.data = self.cursor.fetchall()
-        return self.data
+        return self.fetchall("SELECT * FROM `storages` WHERE user_id = %s;", (user_id,))
 
     def insert(self, user_id, path, type=STORAGE_DEFAULT_TYPE, size=STORAGE_DEFAULT_SIZE) -> int:
         function_name = "Storage.insert"
         self.logger.debug(f"{function_name} called for user:{user_id}, path:{path}, type: {type}, size:{size}")
-        self.reconnect()
         created_date = datetime.datetime.now()
         query = "INSERT INTO `storages` (user_id, path, type, size, used_space, created_date, modified_date) VALUES (%s, %s, %s, %s, %s, %s, %s);"
         arguments = (user_id, path, type, size, 0, created_date, created_date)
-        self.cursor.execute(query, arguments)
-        self.lastrowid = self.cursor.lastrowid
+        self.execute(query, arguments)
         return self.lastrowid
 
     def update_size_by_id(self, storage_id, used_size) -> int:
         function_name = "Storage.update_size_by_id"
         self.logger.debug(f"{function_name} called for storage_id:{storage_id}, used_size:{used_size}")
-        self.reconnect()
         modified_date = datetime.datetime.now()
         query = "UPDATE `storages` SET used_space = %s, modified_date = %s WHERE storage_id = %s;"
         arguments = (used_size, modified_date, storage_id)
-        self.cursor.execute(query, arguments)
-        self.lastrowid = self.cursor.lastrowid
+        self.execute(query, arguments)
         return self.lastrowid
 
 
@@ -185,32 +409,44 @@ class Photo(Model):
     def select_by_user_id(self, user_id) -> list[dict]:
         function_name = "Photo.select_by_user_id"
         self.logger.debug(f"{function_name} called for {user_id}")
-        self.reconnect()
-        self.cursor.execute("SELECT * FROM `photos` WHERE user_id = %s", (user_id,))
-        self.data = self.cursor.fetchall()
-        return self.data
+        return self.fetchall("SELECT * FROM `photos` WHERE user_id = %s", (user_id,))
+
+    def iter_by_user_id(self, user_id) -> Iterator[dict]:
+        function_name = "Photo.iter_by_user_id"
+        self.logger.debug(f"{function_name} called for {user_id}")
+        return self.iterate("SELECT * FROM `photos` WHERE user_id = %s", (user_id,))
+
+    def iter_all(self) -> Iterator[dict]:
+        function_name = "Photo.iter_all"
+        self.logger.debug(f"{function_name} called")
+        return self.iterate("SELECT * FROM `photos`")
 
     def count_by_user_id(self, user_id) -> int:
         function_name = "Photo.count_by_user_id"
         self.logger.debug(f"{function_name} called for {user_id}")
-        self.reconnect()
-        query = "SELECT * FROM `photos` WHERE user_id = %s;"
+        query = "SELECT COUNT(*) FROM `photos` WHERE user_id = %s;"
         arguments = (user_id,)
-        self.cursor.execute(query, arguments)
-        self.rowcount = self.cursor.rowcount
+        self.rowcount = self.scalar(query, arguments)
         return self.rowcount
 
 
     def insert(self, filename, size, storage_id, user_id, hash=None) -> int:
         function_name = "Photo.insert"
         self.logger.debug(f"{function_name} called for filename: {filename}, size: {size}, storage{storage_id}, user_id: {user_id}")
-        self.reconnect()
         upload_date = datetime.datetime.now()
         query = "INSERT INTO `photos` (filename, size, storage_id, user_id, hash, upload_date) VALUES (%s, %s, %s, %s, %s, %s);"
         arguments = (filename, size, storage_id, user_id, hash, upload_date)
-        self.cursor.execute(query, arguments)
-        return self.cursor.lastrowid
-
-
+        self.execute(query, arguments)
+        return self.lastrowid
 
+    def insert_many(self, photos: Iterable[dict]) -> int:
+        function_name = "Photo.insert_many"
+        self.logger.debug(f"{function_name} called")
+        upload_date = datetime.datetime.now()
+        query = "INSERT INTO `photos` (filename, size, storage_id, user_id, hash, upload_date) VALUES (%s, %s, %s, %s, %s, %s);"
+        arguments = [
+            (photo["filename"], photo["size"], photo["storage_id"], photo["user_id"], photo.get("hash"), upload_date)
+            for photo in photos
+        ]
+        return self.execute_many(query, arguments)
 
@@ -0,0 +1,61 @@
+import logging
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import sqlalchemy as sqla
+
+from AlchemyDatabases import User, Photo, Storage
+
+DELETE_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+# Account deletion is split in two: /leave only tombstones the user row (User.deleted_date), the rows and
+# files are removed later by a background worker. The tombstone is cleared last, together with the user row,
+# so a deletion interrupted by a crash is found again and resumed at startup.
+
+class DeletionJob(NamedTuple):
+    user_id: int
+    tg_id: int
+    chat_id: Optional[int] = None
+
+
+def tombstone(s, tg_id: int) -> Optional[int]:
+    # Returns the user_id if the account was live and is now marked for deletion
+    user_id = s.execute(
+        sqla.select(User.user_id).where(User.tg_id == tg_id, User.deleted_date.is_(None))
+    ).scalar()
+    if user_id is None:
+        return None
+    s.execute(
+        sqla.update(User).where(User.user_id == user_id).values(deleted_date=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return user_id
+
+
+def pending(s) -> list[DeletionJob]:
+    rows = s.execute(sqla.select(User.user_id, User.tg_id).where(User.deleted_date.is_not(None))).all()
+    return [DeletionJob(*row) for row in rows]
+
+
+def storages(s, user_id: int) -> list[tuple[str, str]]:
+    return [tuple(row) for row in s.execute(sqla.select(Storage.path, Storage.type).where(Storage.user_id == user_id))]
+
+
+def delete_photo_batch(s, user_id: int, batch_size: int = DELETE_BATCH_SIZE) -> int:
+    # Ids are selected first, MySQL doesn't allow LIMIT in a subquery of DELETE ... IN
+    ids = s.execute(
+        sqla.select(Photo.photo_id).where(Photo.user_id == user_id).limit(batch_size)
+    ).scalars().all()
+    if ids:
+        s.execute(sqla.delete(Photo).where(Photo.photo_id.in_(ids)).execution_options(synchronize_session=False))
+    return len(ids)
+
+
+def finish(s, user_id: int):
+    # Photos stored by an upload that was still in flight when the batches ran go together with the account
+    for model in (Photo, Storage, User):
+        column = User.user_id if model is User else model.user_id
+        s.execute(sqla.delete(model).where(column == user_id).execution_options(synchronize_session=False))
@@ -0,0 +1,136 @@
+import os
+import hashlib
+import logging
+import tempfile
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import telegram
+import sqlalchemy as sqla
+
+from AlchemyDatabases import Photo, Storage
+from StorageBackends import StorageBackend
+import Metrics
+
+INCOMING_FOLDER_NAME = ".incoming"
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 20
+
+logger = logging.getLogger(__name__)
+
+
+class HashingWriter:
+    # File-like wrapper computing sha256 and byte count of everything written through it
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def hexdigest(self) -> str:
+        return self.sha.hexdigest()
+
+
+class IngestedFile(NamedTuple):
+    path: Path
+    hash: str
+    size: int
+
+
+class IngestJob(NamedTuple):
+    tg_id: int
+    chat_id: int
+    user_id: int
+    storage_id: int
+    storage_path: str
+    storage_type: str
+    # None for files unpacked from an /import archive
+    photo: Optional[telegram.PhotoSize]
+
+
+class StagedPhoto(NamedTuple):
+    # A file already put into its storage, waiting for its row in the next batched transaction
+    job: IngestJob
+    filename: str
+    backend: StorageBackend
+    hash: str
+    size: int
+    phash: Optional[int] = None
+    file_id: Optional[str] = None
+    file_unique_id: Optional[str] = None
+
+
+class StoredCopy(NamedTuple):
+    storage_id: int
+    storage_path: str
+    storage_type: str
+    filename: str
+    hash: str
+    size: int
+    phash: Optional[int]
+
+
+def copy_stream(source, writer: HashingWriter):
+    while data := source.read(CHUNK_SIZE):
+        writer.write(data)
+
+
+def download(tg_file: telegram.File, incoming_folder: Path, timeout: float = DOWNLOAD_TIMEOUT) -> IngestedFile:
+    # The file is streamed into a temp file next to the storages, so putting it into a local storage is an atomic rename
+    incoming_folder.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=incoming_folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = HashingWriter(f)
+            if urllib.parse.urlparse(tg_file.file_path).scheme in ("http", "https"):
+                with urllib.request.urlopen(tg_file.file_path, timeout=timeout) as response:
+                    copy_stream(response, writer)
+            else:
+                # Local Bot API server mode: file_path is a path on this host
+                with open(tg_file.file_path, "rb") as source:
+                    copy_stream(source, writer)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    Metrics.DOWNLOAD_BYTES.inc(writer.size)
+    logger.debug(f"Downloaded {tg_file.file_unique_id}: {writer.size} bytes, sha256 {writer.hexdigest()}")
+    return IngestedFile(Path(temp_path), writer.hexdigest(), writer.size)
+
+
+def discard(ingested: IngestedFile):
+    try:
+        os.unlink(ingested.path)
+    except FileNotFoundError:
+        pass
+
+
+def find_stored_copy(s, storage_id: int, criterion) -> Optional[StoredCopy]:
+    # Content lookup by an indexed column (hash or file_unique_id), a copy in the same storage is preferred
+    query = sqla.select(Photo.storage_id, Storage.path, Storage.type, Photo.filename, Photo.hash, Photo.size, Photo.phash) \
+        .join(Storage, Storage.storage_id == Photo.storage_id) \
+        .where(criterion)
+    row = s.execute(query.where(Photo.storage_id == storage_id).limit(1)).first()
+    if row is None:
+        row = s.execute(query.limit(1)).first()
+    return None if row is None else StoredCopy(*row)
+
+
+def reserve_space(s, storage_id: int, size: int, count: int = 1) -> bool:
+    # Atomic in-database increment, the quota check and the update can't be split by a concurrent upload.
+    # photo_count is maintained in the same statement so /stats never has to count photos.
+    result = s.execute(
+        sqla.update(Storage)
+        .where(Storage.storage_id == storage_id, Storage.used_space + size <= Storage.size)
+        .values(used_space=Storage.used_space + size, photo_count=Storage.photo_count + count,
+                modified_date=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
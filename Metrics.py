@@ -0,0 +1,242 @@
+import time
+import bisect
+import logging
+import threading
+import functools
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+import sqlalchemy as sqla
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def get(self, *label_values) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    # Read at scrape time from a callback, so the hot path never has to update it
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [per bucket counts (+Inf last), sum, count]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> dict[tuple, list]:
+        with self.lock:
+            return {key: [list(series[0]), series[1], series[2]] for key, series in self.series.items()}
+
+    def quantile(self, q: float, *label_values) -> Optional[float]:
+        # Upper bound of the bucket holding the quantile, good enough for a summary
+        series = self.snapshot().get(label_values)
+        if series is None or series[2] == 0:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, callback))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram("photobot_handler_seconds", "Handler latency", labels=("handler",))
+HANDLER_ERRORS = REGISTRY.counter("photobot_handler_errors_total", "Handler calls that raised", labels=("handler",))
+SQL_QUERIES = REGISTRY.counter("photobot_sql_queries_total", "SQL statements executed")
+SQL_SECONDS = REGISTRY.histogram("photobot_sql_seconds", "SQL statement execution time")
+SQL_PER_UPDATE = REGISTRY.histogram("photobot_sql_queries_per_update", "SQL statements issued by one handler call",
+                                    labels=("handler",), buckets=COUNT_BUCKETS)
+DOWNLOAD_BYTES = REGISTRY.counter("photobot_download_bytes_total", "Bytes downloaded from Telegram")
+UPLOAD_BYTES = REGISTRY.counter("photobot_upload_bytes_total", "Bytes uploaded to Telegram")
+
+_local = threading.local()
+
+
+def instrument_engine(engine):
+    @sqla.event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @sqla.event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        SQL_SECONDS.observe(time.perf_counter() - started)
+        SQL_QUERIES.inc()
+        _local.queries = getattr(_local, "queries", 0) + 1
+
+    @sqla.event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute doesn't run for a failed statement, its start time must not stay on the connection
+        connection = exception_context.connection
+        started = connection.info.get("query_started") if connection is not None else None
+        if started:
+            started.pop()
+
+
+def timed(name: str, callback: Callable) -> Callable:
+    # Wraps a handler callback: latency histogram, error counter and the SQL statements it issued
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        _local.queries = 0
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(1, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            SQL_PER_UPDATE.observe(_local.queries, name)
+    return wrapper
+
+
+def summary() -> str:
+    lines = []
+    handlers = sorted(HANDLER_SECONDS.snapshot().items())
+    for (name,), (_, total, count) in handlers:
+        p50 = HANDLER_SECONDS.quantile(0.5, name)
+        p95 = HANDLER_SECONDS.quantile(0.95, name)
+        queries = SQL_PER_UPDATE.snapshot().get((name,), [None, 0.0, 0])
+        lines.append(f"{name}: {count} calls, avg {total / count * 1000:.1f}ms, p50 <= {p50 * 1000:g}ms, "
+                     f"p95 <= {p95 * 1000:g}ms, {queries[1] / max(queries[2], 1):.1f} queries/call, "
+                     f"{HANDLER_ERRORS.get(name):g} errors")
+    lines.append(f"SQL: {SQL_QUERIES.get():g} statements")
+    lines.append(f"Downloaded {DOWNLOAD_BYTES.get() / 1024 / 1024:.2f}MB, uploaded {UPLOAD_BYTES.get() / 1024 / 1024:.2f}MB")
+    for metric in REGISTRY.metrics.values():
+        if isinstance(metric, Gauge):
+            lines.extend(line for line in metric.render() if not line.startswith("#"))
+    return "\n".join(lines)
+
+
+class MetricsServer:
+    def __init__(self, listen: str, port: int, registry: Registry = REGISTRY):
+        self.logger = logging.getLogger(__name__)
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(HTTPStatus.NOT_FOUND)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = registry_.render().encode()
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.logger.info(f"Metrics served on {self.httpd.server_address}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,87 @@
+import sys
+import logging
+import argparse
+
+import sqlalchemy as sqla
+from sqlalchemy.schema import CreateColumn
+
+from AlchemyDatabases import Base, Database, User, Photo, Storage
+from Config import database_url
+
+logger = logging.getLogger(__name__)
+
+
+# Base.metadata.create_all only creates missing tables, these steps bring existing tables up to the models.
+# Every step inspects the live schema first, so running the tool again is a no-op.
+
+def add_missing_columns(conn, dry_run: bool) -> list[str]:
+    inspector = sqla.inspect(conn)
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                statements.append(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+    for statement in statements:
+        logger.info(statement)
+        if not dry_run:
+            conn.execute(sqla.text(statement))
+    return statements
+
+
+def find_duplicate_tg_ids(conn) -> list[int]:
+    rows = conn.execute(
+        sqla.select(User.tg_id).group_by(User.tg_id).having(sqla.func.count() > 1)
+    ).all()
+    return [row[0] for row in rows]
+
+
+def create_missing_indexes(conn, dry_run: bool) -> list[str]:
+    inspector = sqla.inspect(conn)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique and table is User.__table__ and (duplicates := find_duplicate_tg_ids(conn)):
+                # Merging accounts is a manual decision, the rest of the migration still runs
+                logger.error(f"Skipping {index.name}: duplicate tg_id values {duplicates} have to be resolved first")
+                continue
+            logger.info(f"CREATE INDEX {index.name} ON {table.name}")
+            if not dry_run:
+                index.create(bind=conn)
+            created.append(index.name)
+    return created
+
+
+def backfill_photo_count(conn, dry_run: bool) -> int:
+    n_photos = sqla.select(sqla.func.count(Photo.photo_id)) \
+        .where(Photo.storage_id == Storage.storage_id) \
+        .scalar_subquery()
+    statement = sqla.update(Storage).values(photo_count=n_photos).where(Storage.photo_count != n_photos)
+    logger.info(str(statement))
+    if dry_run:
+        return 0
+    return conn.execute(statement).rowcount
+
+
+def migrate(engine, dry_run: bool = False):
+    with engine.begin() as conn:
+        if not dry_run:
+            # Tables that don't exist yet are created whole, the steps below only see existing ones
+            Base.metadata.create_all(bind=conn)
+        columns = add_missing_columns(conn, dry_run)
+        indexes = create_missing_indexes(conn, dry_run)
+        storages = backfill_photo_count(conn, dry_run)
+    logger.info(f"Migration {'checked' if dry_run else 'done'}: {len(columns)} columns, {len(indexes)} indexes, "
+                f"{storages} storages recounted")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bring an existing Photobot database up to the current models")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be changed")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format="%(asctime)s [%(levelname)-5.5s]  %(message)s")
+    migrate(Database(database_url()).engine, dry_run=args.dry_run)
@@ -0,0 +1,183 @@
+import time
+import logging
+import threading
+from collections import deque
+
+import cachetools
+import telegram
+import telegram.error
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+import Metrics
+
+# Telegram allows about 30 messages per second overall and about one per second in a chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+SENDERS = 4
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1
+STOP_TIMEOUT = 5
+
+MESSAGES = Metrics.REGISTRY.counter("photobot_outbox_messages_total", "Texts queued for delivery")
+API_CALLS = Metrics.REGISTRY.counter("photobot_outbox_api_calls_total", "sendMessage calls made by the outbox")
+THROTTLED = Metrics.REGISTRY.counter("photobot_outbox_throttled_total", "sendMessage calls answered with RetryAfter")
+DROPPED = Metrics.REGISTRY.counter("photobot_outbox_dropped_total", "Texts given up on")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        # Seconds until a token is available
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class ChatQueue:
+    __slots__ = ("texts", "busy", "blocked_until", "attempts")
+
+    def __init__(self):
+        self.texts: deque[str] = deque()
+        self.busy = False
+        self.blocked_until = 0.0
+        self.attempts = 0
+
+
+class Outbox:
+    # Texts are queued per chat and sent by a few sender threads, so handlers never wait for Telegram.
+    # A chat is handled by one sender at a time, which keeps its texts in order; consecutive texts are
+    # merged into one message. A global and a per-chat token bucket keep us under the flood limits,
+    # RetryAfter and network errors put the texts back and pause only the chat concerned.
+    def __init__(self, bot: telegram.Bot, senders: int = SENDERS, rate: float = GLOBAL_RATE, burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST):
+        self.logger = logging.getLogger(__name__)
+        self.bot = bot
+        self.condition = threading.Condition()
+        self.chats: dict[int, ChatQueue] = {}
+        self.bucket = TokenBucket(rate, burst)
+        # An idle chat's bucket is full again after burst / rate seconds, there is no need to keep it longer
+        self.chat_buckets = cachetools.TTLCache(maxsize=100000, ttl=chat_burst / chat_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.run, name=f"outbox-{n}", daemon=True) for n in range(senders)]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self, chat_id: int, text: str):
+        MESSAGES.inc()
+        with self.condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = ChatQueue()
+            chat.texts.append(text)
+            self.condition.notify()
+
+    def pending(self) -> int:
+        with self.condition:
+            return sum(len(chat.texts) for chat in self.chats.values())
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # Reinserted on every use so the TTL counts from the last message
+        self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def next_chat(self):
+        # Called with the condition held; returns a chat that may send now or the time to wait for one.
+        # A linear scan, the number of chats with queued texts stays small.
+        now = time.monotonic()
+        wait = None
+        global_delay = self.bucket.delay(now)
+        for chat_id, chat in self.chats.items():
+            if chat.busy:
+                continue
+            delay = max(global_delay, chat.blocked_until - now, self.chat_bucket(chat_id).delay(now))
+            if delay <= 0:
+                return chat_id, chat, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, None, wait
+
+    def take_texts(self, chat: ChatQueue) -> list[str]:
+        texts = [chat.texts.popleft()]
+        length = len(texts[0])
+        while chat.texts and length + 1 + len(chat.texts[0]) <= MAX_MESSAGE_LENGTH:
+            length += 1 + len(chat.texts[0])
+            texts.append(chat.texts.popleft())
+        return texts
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped and not any(chat.texts for chat in self.chats.values()):
+                        return
+                    chat_id, chat, wait = self.next_chat()
+                    if chat is not None:
+                        break
+                    self.condition.wait(wait)
+                self.bucket.take()
+                self.chat_bucket(chat_id).take()
+                chat.busy = True
+                texts = self.take_texts(chat)
+            requeue, retried, delay = False, False, 0.0
+            try:
+                API_CALLS.inc()
+                self.bot.send_message(chat_id=chat_id, text="\n".join(texts))
+            except telegram.error.RetryAfter as e:
+                THROTTLED.inc()
+                self.logger.warning(f"Flood limit hit for chat {chat_id}, retrying in {e.retry_after}s")
+                requeue, delay = True, e.retry_after
+            except (telegram.error.BadRequest, telegram.error.ChatMigrated) as e:
+                # Permanent; BadRequest is a NetworkError in PTB 13 and must not reach the retry below
+                DROPPED.inc(len(texts))
+                self.logger.error(f"Couldn't send {len(texts)} texts to chat {chat_id}: {e}")
+            except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+                requeue, retried, delay = True, True, RETRY_DELAY * 2 ** chat.attempts
+                self.logger.warning(f"Sending to chat {chat_id} failed: {e}; retrying in {delay}s")
+            except telegram.error.TelegramError as e:
+                DROPPED.inc(len(texts))
+                self.logger.error(f"Couldn't send {len(texts)} texts to chat {chat_id}: {e}")
+            with self.condition:
+                chat.busy = False
+                # Only network errors count towards giving up, RetryAfter is always honoured
+                chat.attempts = chat.attempts + 1 if retried else 0
+                if requeue and chat.attempts < MAX_ATTEMPTS:
+                    chat.texts.extendleft(reversed(texts))
+                    chat.blocked_until = time.monotonic() + delay
+                elif requeue:
+                    chat.attempts = 0
+                    DROPPED.inc(len(texts))
+                    self.logger.error(f"Giving up on {len(texts)} texts to chat {chat_id}")
+                if not chat.texts and self.chats.get(chat_id) is chat:
+                    del self.chats[chat_id]
+                self.condition.notify_all()
+
+    def join(self):
+        # Waits until everything queued so far has been sent or given up on
+        with self.condition:
+            while any(chat.texts or chat.busy for chat in self.chats.values()):
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        # Texts still waiting for a retry are not worth holding up the shutdown for long
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
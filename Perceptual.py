@@ -0,0 +1,167 @@
+import time
+import logging
+import importlib.util
+import threading
+from pathlib import Path
+from typing import Optional
+
+import sqlalchemy as sqla
+
+from AlchemyDatabases import Photo
+import Metrics
+
+# Pillow and NumPy are only needed for near-duplicate detection, without them it is switched off.
+# They are imported by load() on first use, at import time they would add a good part of the startup.
+Image = None
+np = None
+
+HASH_SIZE = 8
+INITIAL_CAPACITY = 64
+
+LOOKUP_SECONDS = Metrics.REGISTRY.histogram("photobot_phash_lookup_seconds", "Near-duplicate index lookups",
+                                            buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+NEAR_DUPLICATES = Metrics.REGISTRY.counter("photobot_near_duplicates_total", "Uploads close to a stored photo",
+                                           labels=("action",))
+
+logger = logging.getLogger(__name__)
+
+
+def available() -> bool:
+    return importlib.util.find_spec("PIL") is not None and importlib.util.find_spec("numpy") is not None
+
+
+def load():
+    global Image, np
+    if np is None:
+        from PIL import Image as pil_image
+        import numpy
+        Image, np = pil_image, numpy
+
+
+def dhash(path: Path) -> Optional[int]:
+    # Difference hash: a 9x8 grayscale thumbnail, one bit per horizontally adjacent pixel pair.
+    # Survives recompression and resizing, which is what Telegram does to forwarded photos.
+    if not available():
+        return None
+    load()
+    try:
+        with Image.open(path) as image:
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = list(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.debug(f"No perceptual hash for {path}: {e}")
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            value = value << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return value
+
+
+def to_signed(value: int) -> int:
+    # Photo.phash is a signed BIGINT
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+def popcount(x):
+    # Bit count of every element of a uint64 array
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+class UserHashes:
+    # Hashes of one user's photos in a contiguous uint64 array, searched with one vectorized XOR + popcount.
+    # Removal swaps the last element into the gap, like PhotoIndex.UserPhotos.
+    __slots__ = ("hashes", "ids", "positions", "size")
+
+    def __init__(self):
+        self.hashes = np.zeros(INITIAL_CAPACITY, dtype=np.uint64)
+        self.ids = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.positions: dict[int, int] = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, photo_id: int, value: int):
+        if photo_id in self.positions:
+            self.hashes[self.positions[photo_id]] = value
+            return
+        if self.size == len(self.hashes):
+            self.hashes = np.resize(self.hashes, self.size * 2)
+            self.ids = np.resize(self.ids, self.size * 2)
+        self.hashes[self.size] = value
+        self.ids[self.size] = photo_id
+        self.positions[photo_id] = self.size
+        self.size += 1
+
+    def remove(self, photo_id: int):
+        position = self.positions.pop(photo_id, None)
+        if position is None:
+            return
+        self.size -= 1
+        if position < self.size:
+            self.hashes[position] = self.hashes[self.size]
+            self.ids[position] = self.ids[self.size]
+            self.positions[int(self.ids[position])] = position
+
+    def nearest(self, value: int) -> Optional[tuple[int, int]]:
+        # (photo_id, Hamming distance) of the closest hash
+        if not self.size:
+            return None
+        distances = popcount(self.hashes[:self.size] ^ np.uint64(value))
+        position = int(distances.argmin())
+        return int(self.ids[position]), int(distances[position])
+
+
+class NearDuplicateIndex:
+    # Per-user perceptual hash index, loaded on the user's first upload
+    def __init__(self, sessionmaker):
+        self.sql = sessionmaker
+        self.lock = threading.Lock()
+        self.users: dict[int, UserHashes] = {}
+
+    def load(self, user_id: int) -> UserHashes:
+        with self.lock:
+            hashes = self.users.get(user_id)
+        if hashes is not None:
+            return hashes
+        load()
+        hashes = UserHashes()
+        with self.sql.begin() as s:
+            rows = s.execute(
+                sqla.select(Photo.photo_id, Photo.phash).where(Photo.user_id == user_id, Photo.phash.is_not(None))
+            )
+            for photo_id, value in rows:
+                hashes.add(photo_id, to_unsigned(value))
+        with self.lock:
+            return self.users.setdefault(user_id, hashes)
+
+    def nearest(self, user_id: int, value: int) -> Optional[tuple[int, int]]:
+        hashes = self.load(user_id)
+        started = time.perf_counter()
+        with self.lock:
+            result = hashes.nearest(value)
+        LOOKUP_SECONDS.observe(time.perf_counter() - started)
+        return result
+
+    def add(self, user_id: int, photo_id: int, value: int):
+        # Only users already loaded are updated, the others get the photo from the database on load.
+        # Lookups and additions for one user all happen on the same ingest worker, so they can't cross a load.
+        with self.lock:
+            hashes = self.users.get(user_id)
+            if hashes is not None:
+                hashes.add(photo_id, value)
+
+    def drop(self, user_id: int):
+        with self.lock:
+            self.users.pop(user_id, None)
@@ -0,0 +1,356 @@
+import time
+import array
+import bisect
+import random
+import threading
+import logging
+from datetime import timezone
+from typing import NamedTuple, Optional
+
+import sqlalchemy as sqla
+
+from AlchemyDatabases import Photo, Storage
+
+# An alias table is rebuilt once it is this old, the age decay of the weights has moved on by then
+TABLE_MAX_AGE = 3600
+# Photos added after the build are drawn from a small side list until it grows past this share of the table
+PENDING_SHARE = 0.25
+PENDING_MIN = 16
+
+
+class IndexedPhoto(NamedTuple):
+    photo_id: int
+    filename: str
+    file_id: Optional[str] = None
+    variant_count: int = 0
+    weight: float = 1.0
+    # Upload time as a Unix timestamp, 0 when unknown
+    uploaded: float = 0.0
+
+
+def indexed_photo(photo_id, filename, file_id, variant_count, weight, upload_date) -> IndexedPhoto:
+    uploaded = upload_date.replace(tzinfo=timezone.utc).timestamp() if upload_date is not None else 0.0
+    return IndexedPhoto(photo_id, filename, file_id, variant_count, weight, uploaded)
+
+
+def indexed_columns():
+    return Photo.photo_id, Photo.filename, Photo.file_id, Photo.variant_count, Photo.weight, Photo.upload_date
+
+
+class Weighting(NamedTuple):
+    # Effective weight of a photo: its base weight (see /fav) halved every half_life seconds since the upload,
+    # but never below floor times the base weight; half_life 0 turns the decay off
+    half_life: float = 30 * 86400
+    floor: float = 0.1
+
+    def weight(self, entry: IndexedPhoto, now: float) -> float:
+        if not self.half_life:
+            return entry.weight
+        age = max(0.0, now - entry.uploaded)
+        return entry.weight * max(self.floor, 0.5 ** (age / self.half_life))
+
+
+class AliasTable:
+    # Vose's alias method: built in O(n), every draw is one uniform slot and one biased coin
+    __slots__ = ("ids", "probability", "alias", "total")
+
+    def __init__(self, ids: list[int], weights: list[float]):
+        n = len(ids)
+        self.ids = array.array("q", ids)
+        self.probability = array.array("d", [1.0]) * n
+        self.alias = array.array("q", range(n))
+        self.total = sum(weights)
+        if not n or self.total <= 0:
+            return
+        scaled = [weight * n / self.total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1 up to rounding errors
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def draw(self) -> int:
+        slot = random.randrange(len(self.ids))
+        return self.ids[slot] if random.random() < self.probability[slot] else self.ids[self.alias[slot]]
+
+
+class UserPhotos:
+    # Compact per-user list of photos; positions let us remove in O(1) by swapping with the last element.
+    # bag holds the photo_ids not shown yet in the current round, so nothing repeats until all were shown.
+    # For weighted sampling, table is an alias table built lazily on the first draw after it went stale;
+    # photos added since are kept in pending with cumulative weights, removed ones are rejected on draw.
+    # The table is built from a snapshot without the index lock (see PhotoIndex.refresh); fresh collects
+    # the photos added meanwhile and version tells whether a weight changed.
+    __slots__ = ("entries", "positions", "bag", "table", "built", "pending", "cumulative", "removed", "building",
+                 "fresh", "version")
+
+    def __init__(self, entries=()):
+        self.entries: list[IndexedPhoto] = []
+        self.positions: dict[int, int] = {}
+        self.bag = array.array("q")
+        self.table: Optional[AliasTable] = None
+        self.built = 0.0
+        self.pending: list[int] = []
+        self.cumulative: list[float] = []
+        self.removed = 0
+        self.building = False
+        self.fresh: list[IndexedPhoto] = []
+        self.version = 0
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry: IndexedPhoto):
+        if entry.photo_id in self.positions:
+            self.entries[self.positions[entry.photo_id]] = entry
+            return
+        self.positions[entry.photo_id] = len(self.entries)
+        self.entries.append(entry)
+        self.bag.append(entry.photo_id)
+        if self.building:
+            self.fresh.append(entry)
+        if self.table is not None:
+            # A fresh upload, no age decay yet
+            total = self.cumulative[-1] if self.cumulative else 0.0
+            self.pending.append(entry.photo_id)
+            self.cumulative.append(total + entry.weight)
+
+    def remove(self, photo_id: int):
+        position = self.positions.pop(photo_id, None)
+        if position is None:
+            return
+        self.removed += 1
+        last = self.entries.pop()
+        if position < len(self.entries):
+            self.entries[position] = last
+            self.positions[last.photo_id] = position
+
+    def set_file_id(self, argument: tuple[int, Optional[str]]):
+        photo_id, file_id = argument
+        if photo_id in self.positions:
+            position = self.positions[photo_id]
+            self.entries[position] = self.entries[position]._replace(file_id=file_id)
+
+    def set_variant_count(self, argument: tuple[int, int]):
+        photo_id, variant_count = argument
+        if photo_id in self.positions:
+            position = self.positions[photo_id]
+            self.entries[position] = self.entries[position]._replace(variant_count=variant_count)
+
+    def set_weight(self, argument: tuple[int, float]):
+        photo_id, weight = argument
+        if photo_id in self.positions:
+            position = self.positions[photo_id]
+            self.entries[position] = self.entries[position]._replace(weight=weight)
+            # Rare compared to draws, the table is rebuilt on the next one
+            self.version += 1
+            self.built = 0.0
+
+    def sample(self, n: int) -> list[IndexedPhoto]:
+        # Incremental Fisher-Yates over the bag: swap a random unseen id to the end and pop it.
+        # Removed photos stay in the bag and are skipped when drawn.
+        n = min(n, len(self.entries))
+        picked: list[IndexedPhoto] = []
+        taken = set()
+        while len(picked) < n:
+            if not self.bag:
+                self.bag = array.array("q", (entry.photo_id for entry in self.entries if entry.photo_id not in taken))
+            position = random.randrange(len(self.bag))
+            self.bag[position], self.bag[-1] = self.bag[-1], self.bag[position]
+            photo_id = self.bag.pop()
+            if photo_id in self.positions and photo_id not in taken:
+                taken.add(photo_id)
+                picked.append(self.entries[self.positions[photo_id]])
+        return picked
+
+    def snapshot(self) -> tuple[list[IndexedPhoto], int, int]:
+        self.building = True
+        self.fresh = []
+        return list(self.entries), self.removed, self.version
+
+    def install(self, table: AliasTable, now: float, removed: int, version: int):
+        # Photos added during the build are pending for the new table, a weight changed meanwhile keeps it stale
+        self.table = table
+        self.built = now if version == self.version else 0.0
+        self.pending, self.cumulative = [], []
+        total = 0.0
+        for entry in self.fresh:
+            total += entry.weight
+            self.pending.append(entry.photo_id)
+            self.cumulative.append(total)
+        self.removed -= removed
+        self.building, self.fresh = False, []
+
+    def is_stale(self, now: float) -> bool:
+        if self.table is None or now - self.built > TABLE_MAX_AGE:
+            return True
+        # Geometric thresholds, so the O(n) rebuilds are amortized over the uploads and removals in between
+        limit = max(PENDING_MIN, PENDING_SHARE * len(self.table))
+        return len(self.pending) > limit or self.removed > limit
+
+    def draw(self) -> int:
+        pending_total = self.cumulative[-1] if self.cumulative else 0.0
+        r = random.random() * (self.table.total + pending_total)
+        if r < self.table.total or not self.pending:
+            return self.table.draw()
+        return self.pending[min(bisect.bisect_right(self.cumulative, r - self.table.total), len(self.pending) - 1)]
+
+    def weighted_sample(self, n: int) -> list[IndexedPhoto]:
+        # Up to n distinct photos, each draw in proportion to its weight. Repeats and removed photos are
+        # drawn again, a few times at most; whatever is still missing then is filled in uniformly.
+        n = min(n, len(self.entries))
+        if not n:
+            return []
+        picked: list[IndexedPhoto] = []
+        taken = set()
+        for _ in range(8 * n):
+            if len(picked) == n:
+                break
+            photo_id = self.draw()
+            if photo_id in self.positions and photo_id not in taken:
+                taken.add(photo_id)
+                picked.append(self.entries[self.positions[photo_id]])
+        if len(picked) < n:
+            rest = [entry for entry in self.entries if entry.photo_id not in taken]
+            picked += random.sample(rest, n - len(picked))
+        return picked
+
+
+class PhotoIndex:
+    # With a weighting, photos are drawn in proportion to their weight, otherwise from the shuffle bag
+    def __init__(self, sessionmaker, weighting: Weighting = None):
+        self.logger = logging.getLogger(__name__)
+        self.sql = sessionmaker
+        self.weighting = weighting
+        self.lock = threading.Lock()
+        self.users: dict[int, UserPhotos] = {}
+        # Changes that arrive while a user's photos are being loaded, replayed once the load finishes
+        self.loading: dict[int, list] = {}
+
+    def is_loaded(self, user_id: int) -> bool:
+        with self.lock:
+            return user_id in self.users
+
+    def load(self, user_id: int) -> UserPhotos:
+        with self.lock:
+            if user_id in self.users:
+                return self.users[user_id]
+            self.loading.setdefault(user_id, [])
+        try:
+            # Only the columns needed for selection are fetched, no ORM objects are hydrated
+            with self.sql.begin() as s:
+                rows = s.execute(sqla.select(*indexed_columns()).where(Photo.user_id == user_id)).all()
+        except Exception:
+            with self.lock:
+                self.loading.pop(user_id, None)
+            raise
+        photos = UserPhotos(indexed_photo(*row) for row in rows)
+        with self.lock:
+            for method, argument in self.loading.pop(user_id, ()):
+                getattr(photos, method)(argument)
+            photos = self.users.setdefault(user_id, photos)
+        self.logger.debug(f"Photo index loaded for user {user_id}: {len(photos)} photos")
+        return photos
+
+    def add(self, user_id: int, photo_id: int, filename: str, file_id: str = None, weight: float = 1.0):
+        self._apply(user_id, "add", IndexedPhoto(photo_id, filename, file_id, weight=weight, uploaded=time.time()))
+
+    def set_file_id(self, user_id: int, photo_id: int, file_id: Optional[str]):
+        self._apply(user_id, "set_file_id", (photo_id, file_id))
+
+    def set_variant_count(self, user_id: int, photo_id: int, variant_count: int):
+        self._apply(user_id, "set_variant_count", (photo_id, variant_count))
+
+    def set_weight(self, user_id: int, photo_id: int, weight: float):
+        self._apply(user_id, "set_weight", (photo_id, weight))
+
+    def remove(self, user_id: int, photo_id: int):
+        self._apply(user_id, "remove", photo_id)
+
+    def _apply(self, user_id: int, method: str, argument):
+        with self.lock:
+            photos = self.users.get(user_id)
+            if photos is not None:
+                getattr(photos, method)(argument)
+            elif user_id in self.loading:
+                self.loading[user_id].append((method, argument))
+
+    def drop(self, user_id: int):
+        with self.lock:
+            self.users.pop(user_id, None)
+            self.loading.pop(user_id, None)
+
+    def count(self, user_id: int) -> Optional[int]:
+        with self.lock:
+            photos = self.users.get(user_id)
+            return None if photos is None else len(photos)
+
+    def choice(self, user_id: int) -> Optional[IndexedPhoto]:
+        with self.lock:
+            photos = self.users.get(user_id)
+        if photos is None:
+            return self.keyed_choice(user_id)
+        self.refresh(photos)
+        with self.lock:
+            picked = self.pick(photos, 1)
+        return picked[0] if picked else None
+
+    def sample(self, user_id: int, n: int) -> list[IndexedPhoto]:
+        # Up to n distinct photos from the user's shuffle bag; several photos need the index, so it's loaded here
+        if n == 1:
+            photo = self.choice(user_id)
+            return [] if photo is None else [photo]
+        photos = self.load(user_id)
+        self.refresh(photos)
+        with self.lock:
+            return self.pick(photos, n)
+
+    def refresh(self, photos: UserPhotos):
+        # Rebuilds a stale alias table outside the lock, so a large library doesn't hold up everyone else.
+        # Meanwhile other draws use the old table, or the shuffle bag before the first one is ready.
+        now = time.time()
+        with self.lock:
+            if self.weighting is None or photos.building or not photos.is_stale(now):
+                return
+            entries, removed, version = photos.snapshot()
+        try:
+            table = AliasTable([entry.photo_id for entry in entries],
+                               [self.weighting.weight(entry, now) for entry in entries])
+        except BaseException:
+            with self.lock:
+                photos.building = False
+            raise
+        with self.lock:
+            photos.install(table, now, removed, version)
+
+    def pick(self, photos: UserPhotos, n: int) -> list[IndexedPhoto]:
+        # Called with the lock held
+        if self.weighting is None or photos.table is None:
+            return photos.sample(n)
+        return photos.weighted_sample(n)
+
+    def keyed_choice(self, user_id: int) -> Optional[IndexedPhoto]:
+        # Fallback for users that are not indexed yet: a uniform offset into the user's photos, counted by
+        # Storage.photo_count, so no full scan and no bias from the gaps other users leave in photo_id.
+        # Weights only apply once the index is loaded.
+        with self.sql.begin() as s:
+            count = s.execute(
+                sqla.select(sqla.func.sum(Storage.photo_count)).where(Storage.user_id == user_id)
+            ).scalar()
+            query = sqla.select(*indexed_columns()).where(Photo.user_id == user_id).order_by(Photo.photo_id).limit(1)
+            row = s.execute(query.offset(random.randrange(count))).first() if count else None
+            if row is None:
+                # The count lags behind a removal, or is missing for rows written before it existed
+                row = s.execute(query).first()
+        return None if row is None else indexed_photo(*row)
@@ -1,111 +1,169 @@
 import datetime
-import os
-import shutil
+import io
+import zipfile
+import contextlib
 import time
+import signal
+import threading
 import telegram.ext
+import telegram.error
 from telegram.ext import Updater, Dispatcher
-from telegram import Update
+from telegram import Update, InputMediaPhoto
 from telegram.ext import CallbackContext
 from telegram.ext import CommandHandler
 from telegram.ext import MessageHandler, Filters
 from uuid import uuid4
+import sqlalchemy as sqla
 from pathlib import Path
-import random
-import hashlib
+from typing import Optional
 import logging
-import logging.handlers
-LOG_BASE_FORMAT = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  <%(name)s>  %(message)s")
+# Handlers are attached by App.setup_logging, importing this module has no side effects
 LOG_ROOT_LOGGER = logging.getLogger(__name__)
-LOG_FILE_LOGGER = logging.handlers.RotatingFileHandler("telegram.log", mode='a', maxBytes=10*1024*1024, backupCount=10, encoding='UTF-8')
-LOG_FILE_LOGGER.setFormatter(LOG_BASE_FORMAT)
-LOG_FILE_LOGGER.setLevel(logging.INFO)
-LOG_ROOT_LOGGER.addHandler(LOG_FILE_LOGGER)
-LOG_CONSOLE_LOGGER = logging.StreamHandler()
-LOG_CONSOLE_LOGGER.setFormatter(LOG_BASE_FORMAT)
-LOG_CONSOLE_LOGGER.setLevel(logging.DEBUG)
-LOG_ROOT_LOGGER.addHandler(LOG_CONSOLE_LOGGER)
-LOG_ROOT_LOGGER.setLevel(logging.DEBUG)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)-5.5s]  <%(name)s>  %(message)s",
-    handlers=(LOG_FILE_LOGGER, LOG_CONSOLE_LOGGER)
-)
-from AlchemyDatabases import User, Photo, Storage, SESSION
+from AlchemyDatabases import User, Photo, Storage, Database
+from Config import Config
+from PhotoIndex import PhotoIndex, Weighting
+from Caches import IdentityCache
+from Sessions import Session, SessionManager, InMemorySessionStore, DatabaseSessionStore, SESSION_UPLOAD, SESSION_DELETE
+import Ingest
+import Deletion
+import Perceptual
+import Variants
+import Archive
+from Reconciler import Reconciler
+from Workers import WorkerPool
+from StorageBackends import Backends
+from Webhook import WebhookServer
+from Outbox import Outbox
+import Metrics
 
-HTTP_API_KEY = os.environ['TGBOT_API_KEY']
+# /random N sends up to this many photos as one album, Telegram's limit for a media group
+RANDOM_MAX_PHOTOS = 10
 
-ROOT_FOLDER = Path(__file__).parent
-PHOTOS_FOLDER = ROOT_FOLDER / "photos"
+INGEST_SUBMIT_TIMEOUT = 5
+INGEST_BATCH_SIZE = 10
 
-ACCOUNT_MAX_NUMBER = 40
+ARCHIVE_QUEUE_SIZE = 16
+ARCHIVE_SEND_TIMEOUT = 120
+IMPORT_BATCH_SIZE = 50
 
-STORAGE_DEFAULT_TYPE = "local"
+# Accounts tombstoned by /leave wait here for the background deleter
+DELETION_QUEUE_SIZE = 1024
 
 
 class Photobot:
-    def __init__(self):
-        # Presetting variables; could be moved to class definition
-        self.user_sessions = {}
+    def __init__(self, config: Config, database: Database):
+        # Built by App.create_app, which also prepares logging and the schema
+        self.config = config
+        self.database = database
+        self.sql = database.sessionmaker
+        store = DatabaseSessionStore(self.sql) if config.session_store == "database" else InMemorySessionStore()
+        self.sessions = SessionManager(self.session_expired, store)
         self.logger = LOG_ROOT_LOGGER
-        self.updater = Updater(token=HTTP_API_KEY, use_context=True)
+        # Set by App.create_app
+        self.startup = None
+        self.updater = Updater(token=config.api_key, use_context=True, base_url=config.api_base_url,
+                               base_file_url=config.api_base_file_url)
         self.dispatcher: Dispatcher = self.updater.dispatcher
         self.jobs: telegram.ext.JobQueue = self.updater.job_queue
-        self.sql = SESSION
-        # Jobs
-        self.cleaning_job = self.jobs.run_repeating(self.cleaner, interval=5, first=1)
+        self.outbox = Outbox(self.updater.bot, senders=config.outbox_senders, rate=config.outbox_rate,
+                             burst=config.outbox_rate, chat_rate=config.outbox_chat_rate)
+        weighting = None
+        if config.random_mode == "weighted":
+            weighting = Weighting(half_life=config.recency_half_life_days * 86400, floor=config.recency_floor)
+        self.photo_index = PhotoIndex(self.sql, weighting)
+        self.identities = IdentityCache(self.sql)
+        self.near_duplicates = None
+        if config.phash_mode != "off" and Perceptual.available():
+            self.near_duplicates = Perceptual.NearDuplicateIndex(self.sql)
+        self.backends = Backends(config.photos_folder, s3_bucket=config.s3_bucket, s3_endpoint=config.s3_endpoint)
+        self.ingest_pool = WorkerPool("ingest", self.ingest_photo, workers=config.ingest_workers,
+                                      queue_size=config.ingest_queue_size,
+                                      batch_handler=self.store_photos, batch_size=INGEST_BATCH_SIZE)
+        self.variant_pool = None
+        if Variants.available():
+            self.variant_pool = WorkerPool("variants", self.generate_variants, workers=config.variant_workers,
+                                           queue_size=config.variant_queue_size)
+        self.reconciler = Reconciler(self.sql, self.backends, config.photos_folder / Ingest.INCOMING_FOLDER_NAME,
+                                     config.storage_default_type, rate=config.reconcile_rate,
+                                     photo_index=self.photo_index)
+        if config.reconcile_interval and config.cluster_index == 0:
+            self.jobs.run_repeating(self.reconciler.run, interval=config.reconcile_interval,
+                                    first=config.reconcile_interval)
+        self.deletion_pool = WorkerPool("deletion", self.delete_account, workers=1, queue_size=DELETION_QUEUE_SIZE)
+        self.export_pool = WorkerPool("export", self.export_archive, workers=config.archive_workers,
+                                      queue_size=ARCHIVE_QUEUE_SIZE)
+        self.import_pool = WorkerPool("import", self.import_archive, workers=config.archive_workers,
+                                      queue_size=ARCHIVE_QUEUE_SIZE)
         # Basic handlers for testing and reference
-        self.echo_handler = MessageHandler(Filters.text & (~Filters.command), self.echo)
+        self.echo_handler = MessageHandler(Filters.text & (~Filters.command), Metrics.timed("echo", self.echo))
         self.dispatcher.add_handler(self.echo_handler)
-        self.caps_handler = CommandHandler('caps', self.caps)
+        self.caps_handler = CommandHandler('caps', Metrics.timed("caps", self.caps))
         self.dispatcher.add_handler(self.caps_handler)
         # Actually useful handlers
-        self.start_handler = CommandHandler('start', self.start)
+        self.start_handler = CommandHandler('start', Metrics.timed("start", self.start))
         self.dispatcher.add_handler(self.start_handler)
-        self.register_handler = CommandHandler('register', self.register)
+        self.register_handler = CommandHandler('register', Metrics.timed("register", self.register))
         self.dispatcher.add_handler(self.register_handler)
-        self.photo_handler = MessageHandler(Filters.photo, self.photo_saver)
+        self.photo_handler = MessageHandler(Filters.photo, Metrics.timed("photo_saver", self.photo_saver))
         self.dispatcher.add_handler(self.photo_handler)
-        self.random_handler = CommandHandler('random', self.random_photo)
+        self.random_handler = CommandHandler('random', Metrics.timed("random_photo", self.random_photo))
         self.dispatcher.add_handler(self.random_handler)
-        self.statistics_handler = CommandHandler('stats', self.statistics)
+        self.statistics_handler = CommandHandler('stats', Metrics.timed("statistics", self.statistics))
         self.dispatcher.add_handler(self.statistics_handler)
+        self.leave_handler = CommandHandler('leave', Metrics.timed("leave", self.leave))
+        self.dispatcher.add_handler(self.leave_handler)
+        self.favorite_handler = CommandHandler('fav', Metrics.timed("favorite", self.favorite))
+        self.dispatcher.add_handler(self.favorite_handler)
+        self.unfavorite_handler = CommandHandler('unfav', Metrics.timed("unfavorite", self.unfavorite))
+        self.dispatcher.add_handler(self.unfavorite_handler)
+        self.export_handler = CommandHandler('export', Metrics.timed("export", self.export))
+        self.dispatcher.add_handler(self.export_handler)
+        self.import_handler = CommandHandler('import', Metrics.timed("import", self.import_help))
+        self.dispatcher.add_handler(self.import_handler)
+        self.document_handler = MessageHandler(Filters.document.zip | Filters.document.file_extension("zip"),
+                                               Metrics.timed("import_document", self.import_document))
+        self.dispatcher.add_handler(self.document_handler)
         # Test handlers; undocumented commands
+        self.metrics_handler = CommandHandler('metrics', self.metrics)
+        self.dispatcher.add_handler(self.metrics_handler)
+        # Metrics
+        self.metrics_server = None
+        Metrics.REGISTRY.gauge("photobot_user_sessions", "Open upload and deletion sessions", lambda: len(self.sessions))
+        Metrics.REGISTRY.gauge("photobot_ingest_pending", "Photos waiting for an ingest worker", self.ingest_pool.pending)
+        Metrics.REGISTRY.gauge("photobot_outbox_pending", "Texts waiting to be sent", self.outbox.pending)
+        Metrics.REGISTRY.gauge("photobot_deletions_pending", "Accounts waiting for the deleter", self.deletion_pool.pending)
+        Metrics.REGISTRY.gauge("photobot_identity_cache_hits", "Identity cache hits", lambda: self.identities.stats()["hits"])
+        Metrics.REGISTRY.gauge("photobot_identity_cache_misses", "Identity cache misses", lambda: self.identities.stats()["misses"])
 
 
+        self.resume_deletions()
         self.logger.info("Telegram bot has started")
 
-    def cleaner(self, context: telegram.ext.CallbackContext):
+    def session_expired(self, session: Session):
         t = time.time()
-        for ids in self.user_sessions.keys():
-            if round(t - self.user_sessions[ids]["timestamp"], 2) >= 10:
-                chat_id = self.user_sessions[ids]["chat_id"]
-                photos = self.user_sessions[ids]["photos"]
-                text = f"Transmission ended after {round(t - self.user_sessions[ids]['first_photo'], 2)} seconds! {photos} received!"
-                context.bot.send_message(chat_id=chat_id, text=text)
-                del self.user_sessions[ids]
-                break
-            if (delta := round(t - self.user_sessions[ids]["deleting"], 2)) >= 20:
-                chat_id = self.user_sessions[ids]["chat_id"]
-                text = f"Deleting operation aborted after {delta}s."
-                del self.user_sessions[ids]
-                break
+        if session.kind == SESSION_UPLOAD:
+            text = f"Transmission ended after {round(t - session.started, 2)} seconds! {session.photos} received!"
+            if session.duplicates:
+                text += f" {session.duplicates} of them were already in your storage."
+        else:
+            text = f"Deleting operation aborted after {round(t - session.started, 2)}s."
+        self.outbox.send(session.chat_id, text)
 
     def start(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
         chat_id = update.effective_chat.id
         self.logger.debug(f"start called; user: {tg_id}")
         text = "Hello, i am a Random Photo Bot! I can select random photo, from photos provided!"
-        context.bot.send_message(chat_id=chat_id, text=text)
-        with self.sql.begin() as s:
-            user: User = s.query(User).filter(User.tg_id == tg_id).first()
-            if user is None:
-                text = "Welcome! Looks like you are not registered yet."
-                context.bot.send_message(chat_id=chat_id, text=text)
-                text = "Run /register to registrate. You will get 256MB of storage for your photos!"
-                context.bot.send_message(chat_id=chat_id, text=text)
-            else:
-                text = "Welcome! You can run /random to get a random photo from your storage or upload more photos."
-                context.bot.send_message(chat_id=chat_id, text=text)
+        self.outbox.send(chat_id, text)
+        identity = self.identities.get(tg_id)
+        if identity is None:
+            text = "Welcome! Looks like you are not registered yet."
+            self.outbox.send(chat_id, text)
+            text = "Run /register to registrate. You will get 256MB of storage for your photos!"
+            self.outbox.send(chat_id, text)
+        else:
+            text = "Welcome! You can run /random to get a random photo from your storage or upload more photos."
+            self.outbox.send(chat_id, text)
 
     def register(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
@@ -115,40 +173,50 @@ class Photobot:
         chat_id = update.effective_chat.id
         self.logger.debug(f"register called; user: {tg_id}")
         text = "Welcome! Now we will now try to create an account for you!"
-        context.bot.send_message(chat_id=chat_id, text=text)
+        self.outbox.send(chat_id, text)
         with self.sql.begin() as s:
             user: User = s.query(User).filter(User.tg_id == tg_id).first()
             n_users = s.query(User).count()
         if user is None:
-            if n_users < ACCOUNT_MAX_NUMBER:
+            if n_users < self.config.account_max_number:
+                storage_name = f"{uuid4()}"
+                backend = self.backends.get(self.config.storage_default_type)
                 try:
+                    backend.create(storage_name)
+                    # User and storage rows are committed together, a failure never leaves half an account
                     with self.sql.begin() as s:
                         new_user: User = User(tg_id=tg_id, username=username, last_name=last_name, first_name=first_name)
                         s.add(new_user)
-                    self.logger.info(f"Created user record for {tg_id}")
-                    storage_name = f"{uuid4()}"
-                    storage_fullpath = PHOTOS_FOLDER / storage_name
-                    os.mkdir(f"{storage_fullpath}")
-                    with self.sql.begin() as s:
-                        storage = Storage(path=storage_name, user_id=new_user.user_id)
+                        s.flush()
+                        storage = Storage(path=storage_name, user_id=new_user.user_id,
+                                          type=self.config.storage_default_type)
                         s.add(storage)
                     self.logger.info(f"Created storage {storage.storage_id} for user {new_user.user_id} tg_id {tg_id}")
                     self.logger.info(f"user {tg_id} successfully registered")
+                    self.identities.invalidate(tg_id)
                     text = "Congratulations! Now you have a profile and 256MB of storage for your photos!"
-                    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                    self.outbox.send(update.effective_chat.id, text)
                 except Exception as e:
-                    # Cleaning sequence if registration failed
-                    # TODO: Create cleaning sequence
-                    ...
+                    # Nothing was committed, only the storage has to go; the reconciler removes it if this fails too
+                    self.logger.exception(f"Registration of {tg_id} failed: {e}")
+                    try:
+                        backend.delete_storage(storage_name)
+                    except Exception as cleanup_error:
+                        self.logger.warning(f"Couldn't remove storage {storage_name}: {cleanup_error}")
+                    text = "Sorry, something went wrong while creating your account. Please try /register again."
+                    self.outbox.send(update.effective_chat.id, text)
             else:
                 logging.warning(f"user {tg_id} couldn't register: user limit reached")
                 text = "I am very sorry, we couldn't create an account for you! We are out of storage space!"
-                context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                self.outbox.send(update.effective_chat.id, text)
                 text = "Try again latter(much latter) or contact alievabbas1@gmail.com for any questions."
-                context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                self.outbox.send(update.effective_chat.id, text)
+        elif user.deleted_date is not None:
+            text = "Your previous account is still being deleted, please run /register again in a minute."
+            self.outbox.send(update.effective_chat.id, text)
         else:
             text = "Looks like you already have registered! You can upload photos or run /random command!"
-            context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+            self.outbox.send(update.effective_chat.id, text)
 
     def echo(self, update: Update, context: CallbackContext):
         user_id = update.effective_user.id
@@ -156,154 +224,637 @@ class Photobot:
         message = update.message.text
         text = f"Echo[Chat: {chat_id}, User: {user_id}]: \"{message}\""
         print("echo called")
-        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        self.outbox.send(update.effective_chat.id, text)
 
     def caps(self, update: Update, context: CallbackContext):
         text_caps = ' '.join(context.args).upper()
         print("caps called")
-        context.bot.send_message(chat_id=update.effective_chat.id, text=text_caps)
+        self.outbox.send(update.effective_chat.id, text_caps)
 
     def photo_saver(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
         chat_id = update.effective_chat.id
         self.logger.debug(f"photo_saver called; user: {tg_id}")
-        with self.sql.begin() as s:
-            user: User = s.query(User).filter(User.tg_id == tg_id).first()
-        if user is None:
+        identity = self.identities.get(tg_id)
+        if identity is None:
             text = "Sorry, you can't upload any photos, because you don't have an account!"
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
             text = "Run /register to get an account!"
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
             self.logger.warning(f"user {tg_id} failed uploading photo")
         else:
-            user_id = user.user_id
+            # The quota itself is enforced when the batch is stored, see store_photos
+            session, created = self.sessions.touch_upload(tg_id, chat_id)
+            if created:
+                text = "Starting the transmission! If no photos will be detected in 10 seconds transmission of photos will be considered closed."
+                self.outbox.send(chat_id, text)
+            if not session.out_of_space:
+                photo = update.message.photo[len(update.message.photo) - 1]
+                job = Ingest.IngestJob(tg_id=tg_id, chat_id=chat_id, user_id=identity.user_id, storage_id=identity.storage_id,
+                                       storage_path=identity.storage_path, storage_type=identity.storage_type,
+                                       photo=photo)
+                # Download, hashing and the DB write happen on the ingest workers, in order per user
+                if not self.ingest_pool.submit(tg_id, job, timeout=INGEST_SUBMIT_TIMEOUT):
+                    self.sessions.update(tg_id, photos=-1)
+                    text = "Sorry, I am receiving too many photos right now, please send this one again a bit later."
+                    self.outbox.send(chat_id, text)
+            else:
+                self.sessions.update(tg_id, photos=-1)
+                text = "Sorry, you can't upload anymore photos, you are out of space!"
+                self.outbox.send(chat_id, text)
+                text = "If you want to resize you storage or delete some photos, contact alievabbas1@gmail.com"
+                self.outbox.send(chat_id, text)
+
+    def ingest_photo(self, job: Ingest.IngestJob):
+        photo = job.photo
+        # The extension is added once the format is known, the original is kept as Telegram sent it
+        name = uuid4().hex
+        self.logger.info(f"File received. id:{photo.file_id}, uid:{photo.file_unique_id}, size:{photo.file_size}, new_name:{name}")
+        backend = self.backends.get(job.storage_type)
+        with self.sql.begin() as s:
+            copy = Ingest.find_stored_copy(s, job.storage_id, Photo.file_unique_id == photo.file_unique_id)
+        if copy is not None and copy.storage_id == job.storage_id:
+            self.count_duplicate(job)
+            return
+        filename = None if copy is None else self.link_copy(copy, job, name)
+        if filename is not None:
+            photo_hash, photo_size, phash = copy.hash, copy.size, copy.phash
+        else:
+            # No transaction is open while the bytes are travelling over the network
+            tg_file = photo.get_file(timeout=2)
+            ingested = Ingest.download(tg_file, self.config.photos_folder / Ingest.INCOMING_FOLDER_NAME)
+            photo_hash, photo_size = ingested.hash, ingested.size
             with self.sql.begin() as s:
-                storage: Storage = s.query(Storage).filter(Storage.user_id == user_id).first()
-                storage_size = storage.size
-                storage_used_space = storage.used_space
-                if storage_used_space < storage_size:
-                    if self.user_sessions.get(tg_id, None) is None:
-                        text = "Starting the transmission! If no photos will be detected in 10 seconds transmission of photos will be considered closed."
-                        self.user_sessions[tg_id] = {}
-                        self.user_sessions[tg_id]["uploading"] = True
-                        self.user_sessions[tg_id]["photos"] = 0
-                        self.user_sessions[tg_id]["chat_id"] = update.effective_chat.id
-                        self.user_sessions[tg_id]["first_photo"] = time.time()
-                        context.bot.send_message(chat_id=chat_id, text=text)
-                    self.user_sessions[tg_id]["timestamp"] = time.time()
-                    self.user_sessions[tg_id]["photos"] += 1
-                    storage_id = storage.storage_id
-                    photo = update.message.photo[len(update.message.photo) - 1]
-                    photo_size = photo.file_size
-                    filename = f"{uuid4()}.png"
-                    self.logger.info(f"File received. id:{photo.file_id}, uid:{photo.file_unique_id}, size:{photo.file_size}, new_name:{filename}")
-                    filepath = PHOTOS_FOLDER / storage.path / filename
-                    photo.get_file(timeout=2).download(custom_path=filepath)
-                    sha = hashlib.sha256()
-                    with open(filepath, "rb") as f:
-                        while data := f.read(8 * 1024):
-                            sha.update(data)
-                    photo_record = Photo(filename=filename, size=photo_size, hash=f"{sha.hexdigest()}", storage_id=storage_id, user_id=user_id)
-                    s.add(photo_record)
-                    storage.used_space += photo_size
-                    self.logger.info(f"Photo {photo_record.photo_id} added to {storage.storage_id}")
-                else:
-                    text = "Sorry, you can't upload anymore photos, you are out of space!"
-                    context.bot.send_message(chat_id=chat_id, text=text)
-                    text = "If you want to resize you storage or delete some photos, contact alievabbas1@gmail.com"
-                    context.bot.send_message(chat_id=chat_id, text=text)
+                copy = Ingest.find_stored_copy(s, job.storage_id, Photo.hash == ingested.hash)
+            if copy is not None and copy.storage_id == job.storage_id:
+                Ingest.discard(ingested)
+                self.count_duplicate(job)
+                return
+            phash = copy.phash if copy is not None else self.perceptual_hash(ingested.path)
+            if copy is None and self.is_near_duplicate(job, phash):
+                Ingest.discard(ingested)
+                self.count_duplicate(job)
+                return
+            filename = None if copy is None else self.link_copy(copy, job, name)
+            if filename is not None:
+                Ingest.discard(ingested)
+            else:
+                filename = name + Variants.sniff_extension(ingested.path, tg_file.file_path)
+                backend.put(job.storage_path, filename, ingested.path)
+        return Ingest.StagedPhoto(job=job, filename=filename, backend=backend, hash=photo_hash, size=photo_size,
+                                  phash=phash, file_id=photo.file_id, file_unique_id=photo.file_unique_id)
+
+    def perceptual_hash(self, path: Path) -> Optional[int]:
+        if self.near_duplicates is None:
+            return None
+        value = Perceptual.dhash(path)
+        return None if value is None else Perceptual.to_signed(value)
+
+    def is_near_duplicate(self, job: Ingest.IngestJob, phash: Optional[int]) -> bool:
+        if self.near_duplicates is None or phash is None:
+            return False
+        nearest = self.near_duplicates.nearest(job.user_id, Perceptual.to_unsigned(phash))
+        if nearest is None or nearest[1] > self.config.phash_distance:
+            return False
+        self.logger.info(f"Photo {job.photo.file_unique_id} is {nearest[1]} bits from photo {nearest[0]} of user {job.user_id}")
+        Perceptual.NEAR_DUPLICATES.inc(1, self.config.phash_mode)
+        return self.config.phash_mode == "skip"
+
+    def link_copy(self, copy: Ingest.StoredCopy, job: Ingest.IngestJob, name: str) -> Optional[str]:
+        # Returns the filename of the link; content can only be shared between storages kept by the same backend
+        if copy.storage_type != job.storage_type:
+            return None
+        filename = name + Path(copy.filename).suffix
+        backend = self.backends.get(job.storage_type)
+        return filename if backend.link(copy.storage_path, copy.filename, job.storage_path, filename) else None
+
+    def store_photos(self, staged: list[Ingest.StagedPhoto]) -> list[Photo]:
+        # One transaction for everything the worker staged; quota is reserved per storage with an atomic increment
+        admitted, rejected, duplicates = [], [], []
+        seen = set()
+        by_storage: dict[int, list[Ingest.StagedPhoto]] = {}
+        for photo in staged:
+            if (photo.job.storage_id, photo.hash) in seen:
+                duplicates.append(photo)
+            else:
+                seen.add((photo.job.storage_id, photo.hash))
+                by_storage.setdefault(photo.job.storage_id, []).append(photo)
+        try:
+            with self.sql.begin() as s:
+                for storage_id, photos in by_storage.items():
+                    if Ingest.reserve_space(s, storage_id, sum(photo.size for photo in photos), len(photos)):
+                        admitted += photos
+                        continue
+                    # The whole group doesn't fit, admit photos one by one while there is space left
+                    for photo in photos:
+                        if Ingest.reserve_space(s, storage_id, photo.size):
+                            admitted.append(photo)
+                        else:
+                            rejected.append(photo)
+                records = [
+                    Photo(filename=photo.filename, size=photo.size, hash=photo.hash, storage_id=photo.job.storage_id,
+                          user_id=photo.job.user_id, file_id=photo.file_id, file_unique_id=photo.file_unique_id,
+                          phash=photo.phash)
+                    for photo in admitted
+                ]
+                s.add_all(records)
+                s.flush()
+        except Exception:
+            for photo in staged:
+                photo.backend.remove(photo.job.storage_path, photo.filename)
+            raise
+        for photo in rejected + duplicates:
+            photo.backend.remove(photo.job.storage_path, photo.filename)
+        for photo in duplicates:
+            self.count_duplicate(photo.job)
+        storages = {photo.job.storage_id: photo.job for photo in admitted}
+        for record in records:
+            self.photo_index.add(record.user_id, record.photo_id, record.filename, record.file_id)
+            if self.near_duplicates is not None and record.phash is not None:
+                self.near_duplicates.add(record.user_id, record.photo_id, Perceptual.to_unsigned(record.phash))
+            if self.variant_pool is not None:
+                job = storages[record.storage_id]
+                variant_job = Variants.VariantJob(record.photo_id, record.user_id, record.storage_id, job.storage_path,
+                                                  job.storage_type, record.filename)
+                # Without variants the original is delivered, so a full queue only costs bandwidth
+                self.variant_pool.submit(record.user_id, variant_job, timeout=0)
+        self.logger.info(f"Stored {len(records)} photos in {len(by_storage)} storages, {len(rejected)} rejected")
+        notified = set()
+        for photo in rejected:
+            if photo.job.chat_id not in notified:
+                notified.add(photo.job.chat_id)
+                # Further photos of this transmission are refused right away
+                self.sessions.update(photo.job.tg_id, out_of_space=True)
+                text = "Sorry, you can't upload anymore photos, you are out of space!"
+                self.outbox.send(photo.job.chat_id, text)
+                text = "If you want to resize you storage or delete some photos, contact alievabbas1@gmail.com"
+                self.outbox.send(photo.job.chat_id, text)
+        return records
+
+    def generate_variants(self, job: Variants.VariantJob):
+        backend = self.backends.get(job.storage_type)
+        with contextlib.closing(backend.open(job.storage_path, job.filename)) as f:
+            source = io.BytesIO(f.read())
+        incoming_folder = self.config.photos_folder / Ingest.INCOMING_FOLDER_NAME
+        incoming_folder.mkdir(parents=True, exist_ok=True)
+        rendered = Variants.render(source, incoming_folder)
+        if rendered is None:
+            return
+        names = [Variants.variant_name(job.filename, kind) for kind, _, _ in rendered]
+        try:
+            for name, (_, path, _) in zip(names, rendered):
+                backend.put(job.storage_path, name, path)
+        finally:
+            for _, path, _ in rendered:
+                path.unlink(missing_ok=True)
+        total = sum(size for _, _, size in rendered)
+        # Variants count towards the quota
+        with self.sql.begin() as s:
+            stored = Ingest.reserve_space(s, job.storage_id, total, count=0)
+            if stored and s.execute(
+                sqla.update(Photo).where(Photo.photo_id == job.photo_id)
+                .values(variant_count=len(rendered), variants_size=total)
+                .execution_options(synchronize_session=False)
+            ).rowcount != 1:
+                # The photo has been deleted in the meantime
+                Ingest.reserve_space(s, job.storage_id, -total, count=0)
+                stored = False
+        if not stored:
+            for name in names:
+                backend.remove(job.storage_path, name)
+            self.logger.info(f"No variants for photo {job.photo_id}: out of space or deleted")
+            return
+        self.photo_index.set_variant_count(job.user_id, job.photo_id, len(rendered))
+        Variants.VARIANT_BYTES.inc(total)
+
+    def count_duplicate(self, job: Ingest.IngestJob):
+        self.logger.info(f"Photo {job.photo.file_unique_id} is already in storage {job.storage_id}")
+        self.sessions.update(job.tg_id, duplicates=1)
 
     def random_photo(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
         self.logger.debug(f"random_photo called; user: {tg_id}")
         chat_id = update.effective_chat.id
-        with self.sql.begin() as s:
-            user: User = s.query(User).filter(User.tg_id == tg_id).first()
-        if user is None:
+        identity = self.identities.get(tg_id)
+        if identity is None:
             text = "Sorry, you can't call /random, because you don't have an account!"
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
             text = "Run /register to get an account!"
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
             self.logger.warning(f"user {tg_id} failed getting random photo")
         else:
-            user_id = user.user_id
-            with self.sql.begin() as s:
-                photos: tuple[Photo] = s.query(Photo).filter(Photo.user_id == user_id).all()
-                storage: Storage = s.query(Storage).filter(Storage.user_id == user_id).first()
-                storage_path = storage.path
-            if len(photos) == 0:
+            try:
+                n = int(context.args[0]) if context.args else 1
+            except ValueError:
+                n = 0
+            if not 1 <= n <= RANDOM_MAX_PHOTOS:
+                text = f"Usage: /random or /random N, where N is from 1 to {RANDOM_MAX_PHOTOS}."
+                self.outbox.send(chat_id, text)
+                return
+            user_id = identity.user_id
+            if n == 1 and not self.photo_index.is_loaded(user_id):
+                # Warm the index outside of the handler, this call is served by the keyed fallback
+                context.job_queue.run_once(lambda ctx: self.photo_index.load(user_id), when=0)
+            photos = self.photo_index.sample(user_id, n)
+            if not photos:
                 text = "Sorry, you can't call /random, because you don't have any photos!"
-                context.bot.send_message(chat_id=chat_id, text=text)
+                self.outbox.send(chat_id, text)
                 text = "You can upload some just by sending them to the bot!"
-                context.bot.send_message(chat_id=chat_id, text=text)
+                self.outbox.send(chat_id, text)
             else:
-                random_photo_path = random.choice(photos).filename
-                full_photo_path = PHOTOS_FOLDER / storage_path / random_photo_path
-                with open(full_photo_path, "rb") as f:
-                    context.bot.send_photo(chat_id=chat_id, photo=f)
-                self.logger.info(f"Photo {full_photo_path} send to user {tg_id}")
+                self.send_photos(context.bot, chat_id, identity, photos)
+                self.logger.info(f"{len(photos)} photos send to user {tg_id}")
+
+    def send_photos(self, bot: telegram.Bot, chat_id: int, identity, photos: list):
+        # Photos Telegram already has are sent by file_id; if it rejects one of them, everything is uploaded
+        if all(photo.file_id is not None for photo in photos):
+            try:
+                self.deliver(bot, chat_id, [photo.file_id for photo in photos])
+                return
+            except telegram.error.BadRequest as e:
+                self.logger.warning(f"file_id rejected: {e}; uploading from storage")
+                photos = [photo._replace(file_id=None) for photo in photos]
+        backend = self.backends.get(identity.storage_type)
+        media = []
+        for photo in photos:
+            if photo.file_id is not None:
+                media.append(photo.file_id)
+                continue
+            with contextlib.closing(self.open_delivery(backend, identity, photo)) as f:
+                media.append(f.read())
+        try:
+            messages = self.deliver(bot, chat_id, media)
+        except telegram.error.BadRequest as e:
+            if all(photo.file_id is None for photo in photos):
+                raise
+            self.logger.warning(f"file_id rejected: {e}; uploading from storage")
+            return self.send_photos(bot, chat_id, identity, [photo._replace(file_id=None) for photo in photos])
+        Metrics.UPLOAD_BYTES.inc(sum(len(item) for item in media if isinstance(item, bytes)))
+        # Next time Telegram can serve the photos it already has
+        uploaded = [{"b_photo_id": photo.photo_id, "file_id": message.photo[-1].file_id}
+                    for photo, message in zip(photos, messages) if photo.file_id is None]
+        with self.sql.begin() as s:
+            table = Photo.__table__
+            s.execute(sqla.update(table).where(table.c.photo_id == sqla.bindparam("b_photo_id")), uploaded)
+        for row in uploaded:
+            self.photo_index.set_file_id(identity.user_id, row["b_photo_id"], row["file_id"])
+
+    def open_delivery(self, backend, identity, photo):
+        # The delivery variant is much smaller than an original of several megabytes
+        if photo.variant_count:
+            try:
+                return backend.open(identity.storage_path, Variants.variant_name(photo.filename, Variants.DELIVERY))
+            except FileNotFoundError:
+                # Removed with an incomplete set by the reconciler, possibly of another process
+                self.logger.warning(f"Photo {photo.photo_id} has no delivery variant, sending the original")
+                self.photo_index.set_variant_count(identity.user_id, photo.photo_id, 0)
+        return backend.open(identity.storage_path, photo.filename)
+
+    def deliver(self, bot: telegram.Bot, chat_id: int, media: list) -> list[telegram.Message]:
+        # One photo goes as a plain message, several as a single album
+        if len(media) == 1:
+            return [bot.send_photo(chat_id=chat_id, photo=media[0])]
+        return bot.send_media_group(chat_id=chat_id, media=[InputMediaPhoto(item) for item in media])
 
     def statistics(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
         chat_id = update.effective_chat.id
+        identity = self.identities.get(tg_id)
+        if identity is None:
+            text = "Sorry, you can't call /stats, because you don't have an account!"
+            self.outbox.send(chat_id, text)
+            return
         with self.sql.begin() as s:
-            user: User = s.query(User).filter(User.tg_id == tg_id).first()
-            storage: Storage = s.query(Storage).filter(Storage.user_id == user.user_id).first()
-            n_photos: int = s.query(Photo).filter(Photo.user_id == user.user_id).count()
-            used_space_mb = (storage.used_space / 1024) / 1024
-            total_space_mb = (storage.size / 1024) / 1024
+            n_photos, used_space, size = s.execute(
+                sqla.select(Storage.photo_count, Storage.used_space, Storage.size).where(Storage.storage_id == identity.storage_id)
+            ).one()
+        used_space_mb = (used_space / 1024) / 1024
+        total_space_mb = (size / 1024) / 1024
         text = f"You have {n_photos} photos!"
-        context.bot.send_message(chat_id=chat_id, text=text)
+        self.outbox.send(chat_id, text)
         text = f"You have used {used_space_mb:3.4f}MB / {total_space_mb:3.4f}MB"
-        context.bot.send_message(chat_id=chat_id, text=text)
+        self.outbox.send(chat_id, text)
+
+    def metrics(self, update: Update, context: CallbackContext):
+        tg_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        if tg_id not in self.config.admin_ids:
+            self.logger.warning(f"user {tg_id} tried to read metrics")
+            return
+        self.outbox.send(chat_id, Metrics.summary())
 
     def leave(self, update: Update, context: CallbackContext):
         tg_id = update.effective_user.id
         chat_id = update.effective_chat.id
-        if self.user_sessions.get(tg_id, None) is None:
-            self.user_sessions[tg_id] = {}
-            text = "If you are sure you want to delete an account, run /leave again."
-            context.bot.send_message(chat_id=chat_id, text=text)
-            self.user_sessions[tg_id]["deleting"] = time.time()
-            self.user_sessions[tg_id]["chat_id"] = chat_id
+        if self.identities.get(tg_id) is None:
+            text = "You don't have an account to delete."
+            self.outbox.send(chat_id, text)
+            return
+        session = self.sessions.get(tg_id)
+        if session is None:
+            self.sessions.start_delete(tg_id, chat_id)
             text = "If you are sure you want to delete an account, run /leave again."
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
             text = "If it was a mistake, just wait, process will be aborted in 20 seconds."
-            context.bot.send_message(chat_id=chat_id, text=text)
+            self.outbox.send(chat_id, text)
         else:
-            if self.user_sessions[tg_id].get("uploading", None) is None:
-                if self.user_sessions[tg_id].get("deleting", None) is None:
-                    self.user_sessions[tg_id]["deleting"] = time.time()
-                    self.user_sessions[tg_id]["chat_id"] = chat_id
-                    text = "If you are sure you want to delete an account, run /leave again."
-                    context.bot.send_message(chat_id=chat_id, text=text)
-                    text = "If it was a mistake, just wait, process will be aborted in 20 seconds."
-                    context.bot.send_message(chat_id=chat_id, text=text)
-                else:
+            if session.kind == SESSION_DELETE:
+                if self.sessions.pop(tg_id, session.deadline) is not None:
+                    # Only the tombstone is written here, rows and files are removed by the deletion worker
                     with self.sql.begin() as s:
-                        text = "Your account is being deleted now."
-                        context.bot.send_message(chat_id=chat_id, text=text)
-                        user: User = s.query(User).filter(User.tg_id == tg_id).first()
-                        storage: Storage = s.query(Storage).filter(Storage.user_id == user.user_id).first()
-                        photos: list[Photo] = s.query(Photo).filter(Photo.user_id == user.user_id).all()
-                        storage_fullpath = PHOTOS_FOLDER / storage.path
-                        s.delete(user)
-                        s.delete(storage)
-                        for photo in photos:
-                            s.delete(photo)
-                        shutil.rmtree(storage_fullpath)
-                    text = "Your account and all your photos have been successfully deleted, it was nice having you."
-                    context.bot.send_message(chat_id=chat_id, text=text)
+                        user_id = Deletion.tombstone(s, tg_id)
+                    self.identities.invalidate(tg_id)
+                    if user_id is None:
+                        return
+                    self.photo_index.drop(user_id)
+                    self.deletion_pool.submit(user_id, Deletion.DeletionJob(user_id, tg_id, chat_id), timeout=0)
+                    text = "Your account is being deleted now."
+                    self.outbox.send(chat_id, text)
             else:
                 text = "Please wait for photo uploading to finnish before deleting your account."
-                context.bot.send_message(chat_id=chat_id, text=text)
+                self.outbox.send(chat_id, text)
+
+
+
+    def favorite(self, update: Update, context: CallbackContext):
+        self.set_weight(update, self.config.favorite_weight)
+
+    def unfavorite(self, update: Update, context: CallbackContext):
+        self.set_weight(update, 1.0)
+
+    def set_weight(self, update: Update, weight: float):
+        # /fav and /unfav are sent as a reply to a photo the bot sent
+        tg_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        identity = self.identities.get(tg_id)
+        if identity is None:
+            text = "Run /register to get an account!"
+            self.outbox.send(chat_id, text)
+            return
+        replied = update.message.reply_to_message
+        if replied is None or not replied.photo:
+            text = "Reply with /fav to one of your photos to see it more often, or with /unfav to undo that."
+            self.outbox.send(chat_id, text)
+            return
+        sent = replied.photo[-1]
+        # A photo sent by file_id keeps the file_unique_id of the upload, one uploaded from storage got its file_id stored
+        with self.sql.begin() as s:
+            photo_id = s.execute(
+                sqla.select(Photo.photo_id)
+                .where(Photo.user_id == identity.user_id,
+                       sqla.or_(Photo.file_unique_id == sent.file_unique_id, Photo.file_id == sent.file_id))
+                .limit(1)
+            ).scalar()
+            if photo_id is not None:
+                s.execute(
+                    sqla.update(Photo).where(Photo.photo_id == photo_id).values(weight=weight)
+                    .execution_options(synchronize_session=False)
+                )
+        if photo_id is None:
+            text = "Sorry, I couldn't find that photo in your storage."
+        else:
+            self.photo_index.set_weight(identity.user_id, photo_id, weight)
+            text = "Added to your favorites!" if weight > 1.0 else "Removed from your favorites."
+        self.outbox.send(chat_id, text)
+
+    def export(self, update: Update, context: CallbackContext):
+        tg_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        identity = self.identities.get(tg_id)
+        if identity is None:
+            text = "You don't have an account to export."
+            self.outbox.send(chat_id, text)
+            return
+        job = Archive.ExportJob(tg_id, chat_id, identity.user_id, identity.storage_path, identity.storage_type)
+        if self.export_pool.submit(tg_id, job, timeout=0):
+            text = "Packing your photos, they will arrive as zip files of up to 48MB each."
+        else:
+            text = "Too many exports are running right now, please try again later."
+        self.outbox.send(chat_id, text)
+
+    def export_archive(self, job: Archive.ExportJob):
+        started = time.time()
+        backend = self.backends.get(job.storage_type)
+        parts = Archive.export_parts(Archive.photo_pages(self.sql, job.user_id), backend, job.storage_path,
+                                     self.config.photos_folder / Ingest.INCOMING_FOLDER_NAME)
+        n_parts = 0
+        try:
+            for path in parts:
+                n_parts += 1
+                try:
+                    self.send_document(job.chat_id, path, f"photos-{n_parts}.zip")
+                finally:
+                    path.unlink(missing_ok=True)
+        except Exception:
+            text = "Sorry, the export failed, please try /export again later."
+            self.outbox.send(job.chat_id, text)
+            raise
+        finally:
+            parts.close()
+        self.logger.info(f"Exported user {job.user_id} in {n_parts} parts in {round(time.time() - started, 2)}s")
+        text = f"Export finished: {n_parts} files." if n_parts else "You don't have any photos to export yet."
+        self.outbox.send(job.chat_id, text)
+
+    def send_document(self, chat_id: int, path: Path, filename: str):
+        # Documents don't go through the outbox, they are big and sent one at a time anyway
+        while True:
+            try:
+                with open(path, "rb") as f:
+                    self.updater.bot.send_document(chat_id, f, filename=filename, timeout=ARCHIVE_SEND_TIMEOUT)
+                break
+            except telegram.error.RetryAfter as e:
+                time.sleep(e.retry_after)
+        Metrics.UPLOAD_BYTES.inc(path.stat().st_size)
 
+    def import_help(self, update: Update, context: CallbackContext):
+        text = ("Send me a zip file of photos, e.g. one made by /export, and I will add them to your storage. "
+                "Photos you already have are skipped.")
+        self.outbox.send(update.effective_chat.id, text)
 
+    def import_document(self, update: Update, context: CallbackContext):
+        tg_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        identity = self.identities.get(tg_id)
+        document = update.message.document
+        if identity is None:
+            text = "Run /register to get an account before importing photos!"
+        elif document.file_size and document.file_size > self.config.import_max_size:
+            limit = self.config.import_max_size // 1024 // 1024
+            text = f"Sorry, I can only import zip files of up to {limit}MB, please split it."
+        else:
+            job = Archive.ImportJob(tg_id, chat_id, identity.user_id, identity.storage_id, identity.storage_path,
+                                    identity.storage_type, document)
+            if self.import_pool.submit(tg_id, job, timeout=0):
+                text = "Importing your photos, this may take a while."
+            else:
+                text = "Too many imports are running right now, please try again later."
+        self.outbox.send(chat_id, text)
+
+    def import_archive(self, job: Archive.ImportJob):
+        started = time.time()
+        incoming_folder = self.config.photos_folder / Ingest.INCOMING_FOLDER_NAME
+        ingest_job = Ingest.IngestJob(tg_id=job.tg_id, chat_id=job.chat_id, user_id=job.user_id, storage_id=job.storage_id,
+                                      storage_path=job.storage_path, storage_type=job.storage_type, photo=None)
+        downloaded = Ingest.download(job.document.get_file(timeout=2), incoming_folder)
+        imported, skipped, staged = 0, 0, []
+        try:
+            with zipfile.ZipFile(downloaded.path) as archive:
+                with self.sql.begin() as s:
+                    free_space = s.execute(
+                        sqla.select(Storage.size - Storage.used_space).where(Storage.storage_id == job.storage_id)
+                    ).scalar() or 0
+                if not Archive.within_limits(archive, free_space):
+                    self.logger.info(f"Import of user {job.user_id} refused, the archive unpacks to too much")
+                    text = "Sorry, that archive unpacks to far more than your storage has room for."
+                    self.outbox.send(job.chat_id, text)
+                    return
+                manifest = Archive.read_manifest(archive)
+                seen = set()
+                for entry in Archive.import_entries(archive, incoming_folder):
+                    photo = self.stage_import(ingest_job, entry, manifest.get(entry.name), seen)
+                    if photo is None:
+                        skipped += 1
+                        continue
+                    staged.append(photo)
+                    if len(staged) < IMPORT_BATCH_SIZE:
+                        continue
+                    # One transaction per batch, the import stops at the first batch that didn't fit
+                    batch, staged = staged, []
+                    stored = self.store_photos(batch)
+                    imported += len(stored)
+                    if len(stored) < len(batch):
+                        break
+                else:
+                    batch, staged = staged, []
+                    imported += len(self.store_photos(batch))
+        except zipfile.BadZipFile as e:
+            self.logger.info(f"Import of user {job.user_id} failed: {e}")
+            text = "Sorry, I couldn't read that zip file."
+            self.outbox.send(job.chat_id, text)
+            return
+        except Exception:
+            text = f"Sorry, the import failed after {imported} photos, please try again later."
+            self.outbox.send(job.chat_id, text)
+            raise
+        finally:
+            # Files put into the storage but never recorded
+            for photo in staged:
+                photo.backend.remove(photo.job.storage_path, photo.filename)
+            Ingest.discard(downloaded)
+        self.logger.info(f"Imported {imported} photos for user {job.user_id}, {skipped} skipped, "
+                         f"in {round(time.time() - started, 2)}s")
+        text = f"Import finished: {imported} photos added, {skipped} were already in your storage."
+        self.outbox.send(job.chat_id, text)
+
+    def stage_import(self, job: Ingest.IngestJob, entry: Archive.ImportEntry, described: Optional[dict],
+                     seen: set) -> Optional[Ingest.StagedPhoto]:
+        # The same content-hash path as uploads: photos already stored are skipped, copies elsewhere are linked
+        ingested = entry.file
+        with self.sql.begin() as s:
+            copy = Ingest.find_stored_copy(s, job.storage_id, Photo.hash == ingested.hash)
+        if ingested.hash in seen or copy is not None and copy.storage_id == job.storage_id:
+            Ingest.discard(ingested)
+            return None
+        seen.add(ingested.hash)
+        name = uuid4().hex
+        filename = None if copy is None else self.link_copy(copy, job, name)
+        if filename is not None:
+            Ingest.discard(ingested)
+            phash = copy.phash
+        else:
+            phash = self.perceptual_hash(ingested.path)
+            filename = name + entry.extension
+            self.backends.get(job.storage_type).put(job.storage_path, filename, ingested.path)
+        # The manifest of our own export carries the Telegram id of the content, if it matches
+        file_unique_id = None
+        if described is not None and described.get("sha256") == ingested.hash:
+            file_unique_id = described.get("file_unique_id")
+        return Ingest.StagedPhoto(job=job, filename=filename, backend=self.backends.get(job.storage_type),
+                                  hash=ingested.hash, size=ingested.size, phash=phash, file_unique_id=file_unique_id)
+
+    def resume_deletions(self):
+        # Deletions interrupted by a restart are picked up again, a tombstone is only cleared with the user row
+        with self.sql.begin() as s:
+            jobs = [job for job in Deletion.pending(s)
+                    if job.tg_id % self.config.cluster_size == self.config.cluster_index]
+        for job in jobs:
+            self.deletion_pool.submit(job.user_id, job, timeout=0)
+        if jobs:
+            self.logger.info(f"Resuming deletion of {len(jobs)} accounts")
+
+    def delete_account(self, job: Deletion.DeletionJob):
+        started = time.time()
+        with self.sql.begin() as s:
+            storages = Deletion.storages(s, job.user_id)
+        n_photos = 0
+        # Short transactions, one batch each, so the tables are never locked for long
+        while True:
+            with self.sql.begin() as s:
+                deleted = Deletion.delete_photo_batch(s, job.user_id)
+            n_photos += deleted
+            if deleted < Deletion.DELETE_BATCH_SIZE:
+                break
+        for path, type in storages:
+            self.backends.get(type).delete_storage(path)
+        with self.sql.begin() as s:
+            Deletion.finish(s, job.user_id)
+        self.photo_index.drop(job.user_id)
+        if self.near_duplicates is not None:
+            self.near_duplicates.drop(job.user_id)
+        self.identities.invalidate(job.tg_id)
+        self.logger.info(f"Deleted user {job.user_id}: {n_photos} photos, {len(storages)} storages "
+                         f"in {round(time.time() - started, 2)}s")
+        if job.chat_id is not None:
+            text = "Your account and all your photos have been successfully deleted, it was nice having you."
+            self.outbox.send(job.chat_id, text)
 
     def run(self):
+        if self.config.metrics_port:
+            self.metrics_server = Metrics.MetricsServer(self.config.metrics_listen, self.config.metrics_port)
+            self.metrics_server.start()
+        if self.config.webhook_url:
+            try:
+                self.run_webhook()
+            except telegram.error.TelegramError as e:
+                self.logger.error(f"Couldn't set up the webhook: {e}; falling back to polling")
+            else:
+                self.shutdown()
+                return
         self.updater.start_polling()
         self.updater.idle()
+        self.shutdown()
+
+    def run_webhook(self):
+        config = self.config
+        server = WebhookServer(self.updater.bot, self.dispatcher, config.webhook_listen, config.webhook_port,
+                               config.webhook_path, workers=config.webhook_workers, queue_size=config.webhook_queue_size)
+        server.start()
+        try:
+            self.updater.bot.set_webhook(url=f"{config.webhook_url.rstrip('/')}/{config.webhook_path}",
+                                         max_connections=config.webhook_workers)
+        except telegram.error.TelegramError:
+            server.stop()
+            raise
         self.jobs.start()
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopped.set())
+        stopped.wait()
+        self.logger.info("Stopping webhook")
+        server.stop()
+        self.jobs.stop()
+
+    def shutdown(self):
+        self.ingest_pool.stop()
+        self.export_pool.stop()
+        self.import_pool.stop()
+        if self.variant_pool is not None:
+            self.variant_pool.stop()
+        self.deletion_pool.stop()
+        self.sessions.stop()
+        self.outbox.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
 
 
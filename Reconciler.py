@@ -0,0 +1,198 @@
+import os
+import time
+import logging
+import threading
+from datetime import timezone
+from pathlib import Path
+
+import sqlalchemy as sqla
+
+from AlchemyDatabases import Photo, Storage
+from StorageBackends import Backends
+from PhotoIndex import PhotoIndex
+import Variants
+import Metrics
+
+STORAGES_PER_RUN = 20
+FILES_PER_SECOND = 1000
+# Files are put into a storage shortly before their row is written, younger files are never orphans
+ORPHAN_GRACE = 3600
+
+STORAGES = Metrics.REGISTRY.counter("photobot_reconcile_storages_total", "Storages visited by the reconciler",
+                                    labels=("result",))
+ORPHANS = Metrics.REGISTRY.counter("photobot_reconcile_orphans_removed_total", "Orphaned files and directories removed")
+MISSING = Metrics.REGISTRY.counter("photobot_reconcile_missing_files_total", "Photo rows without a file")
+CORRECTED = Metrics.REGISTRY.counter("photobot_reconcile_bytes_corrected_total", "Absolute used_space correction")
+
+
+class Pacer:
+    # Spreads filesystem work out to at most rate entries per second
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.count = 0
+
+    def tick(self, n: int = 1):
+        self.count += n
+        ahead = self.count / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class Reconciler:
+    # Walks the storages a few at a time, in storage_id order, from a JobQueue job. A storage whose change
+    # marker (directory mtimes and Storage.modified_date) hasn't moved since its last visit is skipped.
+    # Otherwise its files are compared with its photo rows: sizes, variants included, are corrected to the bytes
+    # on disk, used_space by the same amount, and files without a row are removed. After every full round,
+    # storage directories without a Storage row and stale downloads are removed too.
+    def __init__(self, sessionmaker, backends: Backends, incoming_folder: Path, default_type: str,
+                 storages_per_run: int = STORAGES_PER_RUN, rate: float = FILES_PER_SECOND, grace: float = ORPHAN_GRACE,
+                 photo_index: PhotoIndex = None):
+        self.logger = logging.getLogger(__name__)
+        self.sql = sessionmaker
+        self.backends = backends
+        # Told about reset variant sets, so /random stops sending variants that are about to be removed
+        self.photo_index = photo_index
+        self.incoming_folder = incoming_folder
+        self.default_type = default_type
+        self.storages_per_run = storages_per_run
+        self.rate = rate
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.cursor = 0
+
+    def run(self, context=None):
+        # Runs are skipped rather than queued while the previous one is still going
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            pacer = Pacer(self.rate)
+            with self.sql.begin() as s:
+                storages = s.execute(
+                    sqla.select(Storage.storage_id, Storage.path, Storage.type, Storage.modified_date,
+                                Storage.reconciled_mtime)
+                    .where(Storage.storage_id > self.cursor)
+                    .order_by(Storage.storage_id)
+                    .limit(self.storages_per_run)
+                ).all()
+            for storage in storages:
+                try:
+                    self.reconcile(pacer, *storage)
+                except Exception as e:
+                    self.logger.exception(f"Reconciling storage {storage.storage_id} failed: {e}")
+                self.cursor = storage.storage_id
+            if len(storages) < self.storages_per_run:
+                self.cursor = 0
+                self.remove_orphaned_storages(pacer)
+                self.remove_stale_downloads(pacer)
+        finally:
+            self.lock.release()
+
+    def reconcile(self, pacer: Pacer, storage_id: int, path: str, type: str, modified_date, reconciled_mtime):
+        backend = self.backends.get(type)
+        marker = backend.mtime(path)
+        if marker is not None:
+            if modified_date is not None:
+                marker = max(marker, modified_date.replace(tzinfo=timezone.utc).timestamp())
+            if reconciled_mtime is not None and marker <= reconciled_mtime:
+                STORAGES.inc(1, "skipped")
+                return
+        files = {}
+        for stored in backend.scan(path):
+            files[stored.filename] = stored
+            pacer.tick()
+        with self.sql.begin() as s:
+            rows = s.execute(
+                sqla.select(Photo.photo_id, Photo.user_id, Photo.filename, Photo.size, Photo.variant_count,
+                            Photo.variants_size)
+                .where(Photo.storage_id == storage_id)
+            ).all()
+        delta, fixes, resets, missing = 0, [], [], 0
+        for photo_id, user_id, filename, size, variant_count, variants_size in rows:
+            stored = files.pop(filename, None)
+            variants = [files.pop(name, None) for name in Variants.variant_names(filename, variant_count)]
+            if stored is None:
+                missing += 1
+                self.logger.warning(f"Photo {photo_id} of storage {storage_id} has no file {filename}")
+            actual_size = size if stored is None else stored.size
+            # Variants are all or nothing, the ones left over from an incomplete set become orphans
+            if None in variants:
+                variant_count, actual_variants_size = 0, 0
+                resets.append((user_id, photo_id))
+            else:
+                actual_variants_size = sum(variant.size for variant in variants)
+            if actual_size != size or actual_variants_size != variants_size:
+                delta += actual_size - size + actual_variants_size - variants_size
+                fixes.append({"b_photo_id": photo_id, "size": actual_size, "variant_count": variant_count,
+                              "variants_size": actual_variants_size})
+        # Before the files of the reset sets go away
+        if self.photo_index is not None:
+            for user_id, photo_id in resets:
+                self.photo_index.set_variant_count(user_id, photo_id, 0)
+        now = time.time()
+        orphans = [stored for stored in files.values() if now - stored.mtime > self.grace]
+        if orphans:
+            # Rows committed since they were read, e.g. by an import holding its files for a while, keep theirs
+            kept = self.referenced(storage_id, {fix["b_photo_id"]: fix["variant_count"] for fix in fixes})
+            orphans = [stored for stored in orphans if stored.filename not in kept]
+        for stored in orphans:
+            backend.remove(path, stored.filename)
+            pacer.tick()
+        if orphans and marker is not None:
+            # Our own removals must not make the storage look changed on the next visit
+            marker = max(marker, backend.mtime(path))
+        with self.sql.begin() as s:
+            if fixes:
+                table = Photo.__table__
+                s.execute(sqla.update(table).where(table.c.photo_id == sqla.bindparam("b_photo_id")), fixes)
+            # A relative update, uploads reserving space in the meantime are not overwritten
+            s.execute(
+                sqla.update(Storage).where(Storage.storage_id == storage_id)
+                .values(used_space=Storage.used_space + delta, reconciled_mtime=marker)
+                .execution_options(synchronize_session=False)
+            )
+        STORAGES.inc(1, "scanned")
+        ORPHANS.inc(len(orphans))
+        MISSING.inc(missing)
+        CORRECTED.inc(abs(delta))
+        if delta or orphans or missing:
+            self.logger.info(f"Storage {storage_id}: used_space corrected by {delta} bytes, {len(orphans)} orphans "
+                             f"removed, {missing} files missing")
+
+    def referenced(self, storage_id: int, variant_counts: dict[int, int]) -> set[str]:
+        # Every file the storage's rows point to; variant_counts overrides the counts this pass is resetting
+        with self.sql.begin() as s:
+            rows = s.execute(
+                sqla.select(Photo.photo_id, Photo.filename, Photo.variant_count).where(Photo.storage_id == storage_id)
+            ).all()
+        names = set()
+        for photo_id, filename, variant_count in rows:
+            names.add(filename)
+            names.update(Variants.variant_names(filename, variant_counts.get(photo_id, variant_count)))
+        return names
+
+    def remove_orphaned_storages(self, pacer: Pacer):
+        # Left behind by failed registrations or interrupted deletions
+        with self.sql.begin() as s:
+            known = {tuple(row) for row in s.execute(sqla.select(Storage.type, Storage.path))}
+        now = time.time()
+        for type in {type for type, _ in known} | {self.default_type}:
+            backend = self.backends.get(type)
+            for stored in backend.storages():
+                pacer.tick()
+                if (type, stored.filename) not in known and now - stored.mtime > self.grace:
+                    self.logger.info(f"Removing orphaned {type} storage {stored.filename}")
+                    backend.delete_storage(stored.filename)
+                    ORPHANS.inc()
+
+    def remove_stale_downloads(self, pacer: Pacer):
+        # Temp files of downloads that never finished, e.g. because the process was killed
+        if not self.incoming_folder.is_dir():
+            return
+        now = time.time()
+        with os.scandir(self.incoming_folder) as entries:
+            for entry in entries:
+                pacer.tick()
+                if entry.is_file(follow_symlinks=False) and now - entry.stat().st_mtime > self.grace:
+                    os.unlink(entry.path)
+                    ORPHANS.inc()
@@ -0,0 +1,220 @@
+import time
+import heapq
+import logging
+import threading
+from typing import Callable, Optional
+
+import sqlalchemy as sqla
+
+from AlchemyDatabases import UserSession
+
+UPLOAD_SESSION_TIMEOUT = 10
+DELETE_SESSION_TIMEOUT = 20
+
+SESSION_UPLOAD = "upload"
+SESSION_DELETE = "delete"
+
+
+class Session:
+    __slots__ = ("tg_id", "kind", "chat_id", "started", "deadline", "photos", "duplicates", "out_of_space")
+
+    def __init__(self, tg_id: int, kind: str, chat_id: int, timeout: float):
+        self.tg_id = tg_id
+        self.kind = kind
+        self.chat_id = chat_id
+        self.started = time.time()
+        # Wall clock, the deadline has to mean the same thing in every bot process
+        self.deadline = self.started + timeout
+        self.photos = 0
+        self.duplicates = 0
+        self.out_of_space = False
+
+    def __repr__(self):
+        return f"<Session(tg_id={self.tg_id}, kind={self.kind}, photos={self.photos})>"
+
+
+class SessionStore:
+    # Where sessions are kept; the manager only keeps the expiry heap. Every tg_id is served by a single
+    # bot process, so a session is never read and written back by two processes at the same time.
+    def __len__(self):
+        raise NotImplementedError
+
+    def get(self, tg_id: int) -> Optional[Session]:
+        raise NotImplementedError
+
+    def put(self, session: Session):
+        raise NotImplementedError
+
+    def remove(self, tg_id: int, deadline: float = None) -> Optional[Session]:
+        # With a deadline, only a session that hasn't been extended since is removed
+        raise NotImplementedError
+
+    def all(self) -> list[Session]:
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self):
+        self.sessions: dict[int, Session] = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, tg_id: int) -> Optional[Session]:
+        return self.sessions.get(tg_id)
+
+    def put(self, session: Session):
+        self.sessions[session.tg_id] = session
+
+    def remove(self, tg_id: int, deadline: float = None) -> Optional[Session]:
+        session = self.sessions.get(tg_id)
+        if session is None or deadline is not None and session.deadline != deadline:
+            return None
+        return self.sessions.pop(tg_id)
+
+    def all(self) -> list[Session]:
+        return list(self.sessions.values())
+
+
+class DatabaseSessionStore(SessionStore):
+    # Sessions in the user_sessions table, shared by all bot processes and kept over restarts
+    def __init__(self, sessionmaker):
+        self.sql = sessionmaker
+
+    @staticmethod
+    def to_session(row: UserSession) -> Session:
+        session = Session.__new__(Session)
+        for name in Session.__slots__:
+            setattr(session, name, getattr(row, name))
+        return session
+
+    def __len__(self):
+        with self.sql.begin() as s:
+            return s.execute(sqla.select(sqla.func.count()).select_from(UserSession)).scalar()
+
+    def get(self, tg_id: int) -> Optional[Session]:
+        with self.sql.begin() as s:
+            row = s.get(UserSession, tg_id)
+            return None if row is None else self.to_session(row)
+
+    def put(self, session: Session):
+        with self.sql.begin() as s:
+            s.merge(UserSession(**{name: getattr(session, name) for name in Session.__slots__}))
+
+    def remove(self, tg_id: int, deadline: float = None) -> Optional[Session]:
+        with self.sql.begin() as s:
+            row = s.get(UserSession, tg_id)
+            if row is None:
+                return None
+            session = self.to_session(row)
+            query = sqla.delete(UserSession).where(UserSession.tg_id == tg_id)
+            if deadline is not None:
+                query = query.where(UserSession.deadline == deadline)
+            # Several processes may expire the same session, the one whose DELETE hits the row reports it
+            if s.execute(query.execution_options(synchronize_session=False)).rowcount != 1:
+                return None
+        return session
+
+    def all(self) -> list[Session]:
+        with self.sql.begin() as s:
+            return [self.to_session(row) for row in s.execute(sqla.select(UserSession)).scalars()]
+
+
+class SessionManager:
+    # Upload and deletion sessions ordered by deadline in a heap. Extending a session pushes a new heap
+    # entry, outdated entries are recognized by their deadline and dropped when they reach the top.
+    def __init__(self, on_expire: Callable[[Session], None], store: SessionStore = None):
+        self.logger = logging.getLogger(__name__)
+        self.on_expire = on_expire
+        self.store = InMemorySessionStore() if store is None else store
+        self.condition = threading.Condition()
+        # Sessions left by a previous run or another process are expired too
+        self.heap: list[tuple[float, int]] = [(session.deadline, session.tg_id) for session in self.store.all()]
+        heapq.heapify(self.heap)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="sessions", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.store)
+
+    def get(self, tg_id: int) -> Optional[Session]:
+        with self.condition:
+            return self.store.get(tg_id)
+
+    def schedule(self, session: Session, timeout: float):
+        session.deadline = time.time() + timeout
+        self.store.put(session)
+        heapq.heappush(self.heap, (session.deadline, session.tg_id))
+        self.condition.notify()
+
+    def touch_upload(self, tg_id: int, chat_id: int) -> tuple[Session, bool]:
+        # Returns the upload session and whether it has just been started
+        with self.condition:
+            session = self.store.get(tg_id)
+            created = session is None or session.kind != SESSION_UPLOAD
+            if created:
+                session = Session(tg_id, SESSION_UPLOAD, chat_id, UPLOAD_SESSION_TIMEOUT)
+            session.photos += 1
+            self.schedule(session, UPLOAD_SESSION_TIMEOUT)
+            return session, created
+
+    def update(self, tg_id: int, photos: int = 0, duplicates: int = 0, out_of_space: bool = None):
+        with self.condition:
+            session = self.store.get(tg_id)
+            if session is None:
+                return
+            session.photos += photos
+            session.duplicates += duplicates
+            if out_of_space is not None:
+                session.out_of_space = out_of_space
+            self.store.put(session)
+
+    def start_delete(self, tg_id: int, chat_id: int) -> Session:
+        with self.condition:
+            session = Session(tg_id, SESSION_DELETE, chat_id, DELETE_SESSION_TIMEOUT)
+            self.schedule(session, DELETE_SESSION_TIMEOUT)
+            return session
+
+    def pop(self, tg_id: int, deadline: float = None) -> Optional[Session]:
+        # With a deadline, the session is only taken if it's still the one that was read
+        with self.condition:
+            return self.store.remove(tg_id, deadline)
+
+    def run(self):
+        while True:
+            expired = []
+            with self.condition:
+                while not expired:
+                    if self.stopped:
+                        return
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    deadline, tg_id = self.heap[0]
+                    delay = deadline - time.time()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    now = time.time()
+                    while self.heap and self.heap[0][0] <= now:
+                        deadline, tg_id = heapq.heappop(self.heap)
+                        try:
+                            session = self.store.remove(tg_id, deadline)
+                        except Exception as e:
+                            self.logger.exception(f"Expiring session of {tg_id} failed: {e}")
+                            continue
+                        if session is not None:
+                            expired.append(session)
+            for session in expired:
+                try:
+                    self.on_expire(session)
+                except Exception as e:
+                    self.logger.exception(f"Expiring {session} failed: {e}")
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
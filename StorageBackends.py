@@ -0,0 +1,237 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+SHARD_WIDTH = 2
+S3_DELETE_BATCH = 1000
+
+
+class StoredFile(NamedTuple):
+    filename: str
+    size: int
+    # When the file was last written or linked, the reconciler's measure of its age
+    mtime: float
+
+
+class StorageBackend:
+    # Every access to photo bytes goes through a backend, selected by Storage.type.
+    # storage_path is Storage.path, filename is Photo.filename.
+    type = None
+
+    def create(self, storage_path: str):
+        raise NotImplementedError
+
+    def put(self, storage_path: str, filename: str, source: Path):
+        # Takes ownership of source, a finished temp file
+        raise NotImplementedError
+
+    def link(self, source_path: str, source_name: str, storage_path: str, filename: str) -> bool:
+        # Stores a second reference to an existing object without sending its bytes again
+        return False
+
+    def open(self, storage_path: str, filename: str) -> BinaryIO:
+        # Raises FileNotFoundError for a missing file, whatever the backend
+        raise NotImplementedError
+
+    def remove(self, storage_path: str, filename: str):
+        raise NotImplementedError
+
+    def delete_storage(self, storage_path: str):
+        raise NotImplementedError
+
+    def scan(self, storage_path: str) -> Iterator[StoredFile]:
+        raise NotImplementedError
+
+    def mtime(self, storage_path: str) -> Optional[float]:
+        # Cheap change marker for a storage, None when the backend can't tell without a full scan
+        return None
+
+    def storages(self) -> Iterator[StoredFile]:
+        # Storage directories that exist in the backend, for finding ones without a Storage row
+        return iter(())
+
+
+class LocalBackend(StorageBackend):
+    # Files are spread over hash-prefix subdirectories of the storage directory, so no directory grows
+    # with the library. Files from the old flat layout are still found at the storage root.
+    type = "local"
+
+    def __init__(self, root: Path, shard_width: int = SHARD_WIDTH):
+        self.logger = logging.getLogger(__name__)
+        self.root = Path(root)
+        self.shard_width = shard_width
+
+    def shard(self, filename: str) -> str:
+        return hashlib.sha1(filename.encode()).hexdigest()[:self.shard_width]
+
+    def path(self, storage_path: str, filename: str) -> Path:
+        return self.root / storage_path / self.shard(filename) / filename
+
+    def existing_path(self, storage_path: str, filename: str) -> Path:
+        path = self.path(storage_path, filename)
+        if path.exists():
+            return path
+        legacy = self.root / storage_path / filename
+        return legacy if legacy.exists() else path
+
+    def create(self, storage_path: str):
+        os.mkdir(self.root / storage_path)
+
+    def put(self, storage_path: str, filename: str, source: Path):
+        destination = self.path(storage_path, filename)
+        destination.parent.mkdir(exist_ok=True)
+        os.replace(source, destination)
+
+    def link(self, source_path: str, source_name: str, storage_path: str, filename: str) -> bool:
+        # Hardlinks share one inode, the filesystem link count is the reference count, so deleting
+        # one storage directory never removes the bytes still referenced from another one
+        destination = self.path(storage_path, filename)
+        try:
+            destination.parent.mkdir(exist_ok=True)
+            os.link(self.existing_path(source_path, source_name), destination)
+            return True
+        except OSError as e:
+            self.logger.warning(f"Couldn't link {source_name} from {source_path}: {e}")
+            return False
+
+    def open(self, storage_path: str, filename: str) -> BinaryIO:
+        return open(self.existing_path(storage_path, filename), "rb")
+
+    def remove(self, storage_path: str, filename: str):
+        try:
+            os.unlink(self.existing_path(storage_path, filename))
+        except FileNotFoundError:
+            pass
+
+    def delete_storage(self, storage_path: str):
+        shutil.rmtree(self.root / storage_path, ignore_errors=True)
+
+    def scan(self, storage_path: str) -> Iterator[StoredFile]:
+        with os.scandir(self.root / storage_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    with os.scandir(entry.path) as shard:
+                        for file in shard:
+                            if file.is_file(follow_symlinks=False):
+                                yield self.stored_file(file)
+                elif entry.is_file(follow_symlinks=False):
+                    yield self.stored_file(entry)
+
+    @staticmethod
+    def stored_file(entry: os.DirEntry) -> StoredFile:
+        # A hardlink keeps the inode's old mtime, only the ctime shows when it was made
+        stat = entry.stat(follow_symlinks=False)
+        return StoredFile(entry.name, stat.st_size, max(stat.st_mtime, stat.st_ctime))
+
+    def mtime(self, storage_path: str) -> Optional[float]:
+        # A file added or removed changes the mtime of its shard directory, a new shard changes the root's
+        root = self.root / storage_path
+        mtime = root.stat().st_mtime
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime)
+        return mtime
+
+    def storages(self) -> Iterator[StoredFile]:
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+                    yield StoredFile(entry.name, 0, entry.stat(follow_symlinks=False).st_mtime)
+
+
+class S3Backend(StorageBackend):
+    # S3-compatible object storage (AWS, MinIO, ...); objects are keyed "<storage_path>/<filename>".
+    # boto3 is only needed when a storage of this type is actually used.
+    type = "s3"
+
+    def __init__(self, bucket: str, endpoint_url: str = None, client=None):
+        self.logger = logging.getLogger(__name__)
+        self.bucket = bucket
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("The s3 storage backend requires boto3 to be installed") from e
+        self.client_error = ClientError
+        if client is None:
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+
+    def key(self, storage_path: str, filename: str) -> str:
+        return f"{storage_path}/{filename}"
+
+    def create(self, storage_path: str):
+        # Prefixes don't need to exist up front
+        pass
+
+    def put(self, storage_path: str, filename: str, source: Path):
+        try:
+            self.client.upload_file(str(source), self.bucket, self.key(storage_path, filename))
+        finally:
+            os.unlink(source)
+
+    def link(self, source_path: str, source_name: str, storage_path: str, filename: str) -> bool:
+        # Server-side copy, the bytes never pass through the bot host
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self.key(storage_path, filename),
+                                    CopySource={"Bucket": self.bucket, "Key": self.key(source_path, source_name)})
+            return True
+        except self.client_error as e:
+            self.logger.warning(f"Couldn't copy {source_name} from {source_path}: {e}")
+            return False
+
+    def open(self, storage_path: str, filename: str) -> BinaryIO:
+        key = self.key(storage_path, filename)
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except self.client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise FileNotFoundError(f"No object {key} in bucket {self.bucket}") from e
+            raise
+
+    def remove(self, storage_path: str, filename: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(storage_path, filename))
+
+    def objects(self, storage_path: str) -> Iterator[dict]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{storage_path}/"):
+            yield from page.get("Contents", ())
+
+    def delete_storage(self, storage_path: str):
+        batch = []
+        for item in self.objects(storage_path):
+            batch.append({"Key": item["Key"]})
+            if len(batch) == S3_DELETE_BATCH:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+
+    def scan(self, storage_path: str) -> Iterator[StoredFile]:
+        for item in self.objects(storage_path):
+            yield StoredFile(item["Key"].rsplit("/", 1)[-1], item["Size"], item["LastModified"].timestamp())
+
+
+class Backends:
+    # Storage.type -> backend, created on first use
+    def __init__(self, photos_folder: Path, s3_bucket: str = None, s3_endpoint: str = None):
+        self.lock = threading.Lock()
+        self.factories = {
+            LocalBackend.type: lambda: LocalBackend(photos_folder),
+            S3Backend.type: lambda: S3Backend(s3_bucket, endpoint_url=s3_endpoint),
+        }
+        self.backends: dict[str, StorageBackend] = {}
+
+    def get(self, type: str) -> StorageBackend:
+        with self.lock:
+            backend = self.backends.get(type)
+            if backend is None:
+                if type not in self.factories:
+                    raise ValueError(f"Unknown storage type {type}")
+                backend = self.backends[type] = self.factories[type]()
+            return backend
@@ -0,0 +1,106 @@
+import os
+import logging
+import importlib.util
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Optional
+
+import Metrics
+
+# Pillow is only needed to generate variants, without it photos are delivered as stored.
+# It is imported with the first variant, like in Perceptual.
+Image = None
+
+DEFAULT_EXTENSION = ".jpg"
+# Magic numbers of the formats Telegram hands out, the file_path suffix is used for anything else
+SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF8", ".gif"),
+)
+
+DELIVERY = "delivery"
+THUMBNAIL = "thumb"
+# Variant kind, longest side in pixels, JPEG quality; a photo has either all of them or none
+VARIANTS = (
+    (DELIVERY, 1280, 82),
+    (THUMBNAIL, 320, 75),
+)
+
+VARIANT_BYTES = Metrics.REGISTRY.counter("photobot_variant_bytes_total", "Bytes of generated variants")
+
+logger = logging.getLogger(__name__)
+
+
+class VariantJob(NamedTuple):
+    photo_id: int
+    user_id: int
+    storage_id: int
+    storage_path: str
+    storage_type: str
+    filename: str
+
+
+def available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def load():
+    global Image
+    if Image is None:
+        from PIL import Image as pil_image
+        Image = pil_image
+
+
+def image_extension(head: bytes) -> Optional[str]:
+    # Extension for the first 12 bytes of a file, None if they aren't from a known image format
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def sniff_extension(path: Path, fallback: str = None) -> str:
+    with open(path, "rb") as f:
+        extension = image_extension(f.read(12))
+    if extension is not None:
+        return extension
+    suffix = Path(fallback or "").suffix.lower()
+    return suffix if suffix and len(suffix) <= 5 else DEFAULT_EXTENSION
+
+
+def variant_name(filename: str, kind: str) -> str:
+    return f"{Path(filename).stem}.{kind}.jpg"
+
+
+def variant_names(filename: str, count: int) -> list[str]:
+    return [variant_name(filename, kind) for kind, _, _ in VARIANTS[:count]]
+
+
+def render(source: BinaryIO, incoming_folder: Path) -> Optional[list[tuple[str, Path, int]]]:
+    # Decodes the original once and writes every variant to a temp file: (kind, path, size) each
+    load()
+    try:
+        with Image.open(source) as image:
+            # JPEG is decoded at a reduced scale right away, much cheaper than a full decode and resize
+            longest = VARIANTS[0][1]
+            image.draft("RGB", (longest, longest))
+            image = image.convert("RGB")
+            rendered = []
+            try:
+                for kind, side, quality in VARIANTS:
+                    image.thumbnail((side, side), Image.LANCZOS)
+                    fd, temp_path = tempfile.mkstemp(dir=incoming_folder, suffix=".part")
+                    rendered.append((kind, Path(temp_path)))
+                    with os.fdopen(fd, "wb") as f:
+                        image.save(f, "JPEG", quality=quality, optimize=True, progressive=True)
+            except BaseException:
+                for _, path in rendered:
+                    os.unlink(path)
+                raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.info(f"No variants: {e}")
+        return None
+    return [(kind, path, os.path.getsize(path)) for kind, path in rendered]
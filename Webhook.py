@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+from telegram import Update
+
+from Workers import WorkerPool
+
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    # Local HTTP listener for Telegram webhooks. Decoded updates go to a WorkerPool keyed by user,
+    # so every user's updates are processed in order; when the worker queue is full the update is
+    # shed with 503 and Telegram delivers it again later.
+    def __init__(self, bot: telegram.Bot, dispatcher, listen: str, port: int, path: str,
+                 workers: int = 8, queue_size: int = 64):
+        self.logger = logging.getLogger(__name__)
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.path = "/" + path.strip("/")
+        self.pool = WorkerPool("webhook", self.process, workers=workers, queue_size=queue_size)
+        self.lock = threading.Lock()
+        self.counters = {"received": 0, "shed": 0, "rejected": 0}
+        self.httpd = ThreadingHTTPServer((listen, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        stats["pending"] = self.pool.pending()
+        return stats
+
+    def process(self, update: Update):
+        self.dispatcher.process_update(update)
+
+    def accept(self, body: bytes) -> HTTPStatus:
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.logger.warning(f"Malformed update: {e}")
+            self.count("rejected")
+            return HTTPStatus.BAD_REQUEST
+        if update is None:
+            self.count("rejected")
+            return HTTPStatus.BAD_REQUEST
+        self.count("received")
+        key = update.effective_user.id if update.effective_user else update.update_id
+        if not self.pool.submit(key, update, timeout=0):
+            self.count("shed")
+            return HTTPStatus.SERVICE_UNAVAILABLE
+        return HTTPStatus.OK
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.reply(HTTPStatus.NOT_FOUND)
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                if length <= 0 or length > WEBHOOK_MAX_BODY:
+                    self.reply(HTTPStatus.REQUEST_ENTITY_TOO_LARGE if length else HTTPStatus.LENGTH_REQUIRED)
+                    return
+                self.reply(server.accept(self.rfile.read(length)))
+
+            def reply(self, status: HTTPStatus):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                server.logger.debug("%s - %s" % (self.address_string(), format % args))
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        self.logger.info(f"Webhook listening on {self.httpd.server_address} at {self.path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.pool.stop()
@@ -0,0 +1,76 @@
+import queue
+import logging
+import threading
+from typing import Callable, Hashable
+
+_STOP = object()
+
+
+class WorkerPool:
+    # Jobs with the same key always land on the same worker, which keeps them in submission order.
+    # Every worker has its own bounded queue, a full queue is reported back to the caller as backpressure.
+    # With a batch_handler, results of the handler are collected per worker and passed on together
+    # once batch_size is reached or the worker's queue runs dry.
+    def __init__(self, name: str, handler: Callable, workers: int = 4, queue_size: int = 32,
+                 batch_handler: Callable = None, batch_size: int = 10):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.batch_size = batch_size
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self.work, args=(q,), name=f"{name}-{n}", daemon=True)
+            for n, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key: Hashable, job, timeout: float = None) -> bool:
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put(job, block=timeout is None or timeout > 0, timeout=timeout)
+            return True
+        except queue.Full:
+            self.logger.warning(f"{self.name} queue is full, job for {key} rejected")
+            return False
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def work(self, q: queue.Queue):
+        batch = []
+        while True:
+            job = q.get()
+            try:
+                if job is _STOP:
+                    return
+                result = self.handler(job)
+                if self.batch_handler is not None and result is not None:
+                    batch.append(result)
+            except Exception as e:
+                self.logger.exception(f"{self.name} job failed: {e}")
+            finally:
+                if job is _STOP or len(batch) >= self.batch_size or q.empty():
+                    self.flush(batch)
+                q.task_done()
+
+    def flush(self, batch: list):
+        if not batch:
+            return
+        try:
+            self.batch_handler(list(batch))
+        except Exception as e:
+            self.logger.exception(f"{self.name} batch of {len(batch)} failed: {e}")
+        finally:
+            batch.clear()
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def stop(self):
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self.threads:
+            thread.join()
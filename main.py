@@ -1,12 +1,20 @@
-import Photobot
+import time
+STARTED = time.monotonic()
+
+import App
+import Cluster
+from Config import Config
 import logging
 
 main_logger = logging.getLogger(__name__)
 main_logger.setLevel(logging.DEBUG)
 
 if __name__ == '__main__':
+    config = Config.from_env()
+    App.setup_logging(config)
     main_logger.info("Main started")
-    bot = Photobot.Photobot()
-    bot.run()
-
-
+    if config.worker_processes > 1:
+        Cluster.Cluster(config).run()
+    else:
+        bot = App.create_app(config, started=STARTED)
+        bot.run()